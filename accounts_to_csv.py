@@ -1,5 +1,6 @@
+from csv_helper import write_csv
+
 import esp
-import csv
 
 # To run this script, please first:
 # - Install the Python SDK: 'pip install esp'
@@ -9,21 +10,20 @@ import csv
 #    2) run 'export ESP_SECRET_ACCESS_KEY=$secret_access_key_from_above_link'
 # - Run 'python3 accounts_to_csv.py' and the csv file will be saved 
 #    in the same directory
+
+# Accounts are yielded page by page as they arrive, rather than collected first
 def get_all_accounts():
     p_accounts = esp.ExternalAccount._all()
-    accounts = []
     last_page = False
     while last_page == False:
         for acct in p_accounts:
-            accounts.append(acct)
+            yield acct
         try:
             p_accounts = p_accounts.next_page()
         except:
             last_page = True
-    return accounts
 
 def format_accounts_for_csv(accounts):
-    f_accounts = []
     for acct in accounts:
         f_acct = {
             'name': acct.name,
@@ -32,16 +32,12 @@ def format_accounts_for_csv(accounts):
             'team': acct.team.name,
             'updated_at': acct.updated_at
                 }
-        f_accounts.append(f_acct)
-    return f_accounts
+        yield f_acct
 
 def generate_csv_from_accounts(accounts):
-   with open('esp_accounts.csv', 'w') as file:
-       headers = ['name', 'account', 'sub-organization', 'team', 'updated_at']
-       writer = csv.DictWriter(file, fieldnames=headers)
-       writer.writeheader()
-       for acct in accounts:
-           writer.writerow(acct)
+   headers = ['name', 'account', 'sub-organization', 'team', 'updated_at']
+   writer = write_csv('esp_accounts.csv', headers, accounts)
+   print("Wrote %d accounts, %d bytes" % (writer.rows, writer.bytes))
 
 def run():
     print("Starting...")
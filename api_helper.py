@@ -30,72 +30,656 @@
 # API helper
 #
 
-from wsgiref.handlers import format_date_time
-from datetime import datetime
-from time import mktime
+from request_signer import RequestSigner
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs, unquote
+from email.utils import parsedate_to_datetime
+from urllib3.exceptions import NewConnectionError
+from collections import deque, namedtuple
 
-import hashlib
 import codecs
-import hmac
-import base64
+import re
+import json
 import requests
+import threading
+import random
+import time
 import os
 
+# File locks for sharing a rate limit between processes (not available on Windows)
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ESP API endpoint - http://api-docs.evident.io/
+# Set ESP_API_URL to point at another endpoint, such as esp_mock_server.py
+api_url = os.environ.get('ESP_API_URL', 'https://api.evident.io')
+
+
+def page_uri(uri, number, size):
+    """ Set page[number] and page[size] on a uri """
+
+    path, _, query = uri.partition('?')
+    params = [ p for p in query.split('&') if p and unquote(p.split('=')[0]) not in ('page[number]', 'page[size]') ]
+    params += [ 'page[number]=%d' % (number), 'page[size]=%d' % (size) ]
+
+    return path + '?' + '&'.join(params)
+
+
+def page_number(link):
+    """ Page number from a pagination link, None if there isn't one """
+
+    # Example: https://api.evident.io/api/v2/reports/22952488/alerts?page%5Bnumber%5D=6&page%5Bsize%5D=20
+    # Should return 6
+    if not link:
+        return None
+
+    try:
+        return int(parse_qs(urlsplit(link).query)['page[number]'][0])
+    except (KeyError, ValueError):
+        return None
+
+
+def collection_count(page):
+    """ Document count of a collection, from its first page at page[size]=1 """
+
+    if 'errors' in page:
+        error = page['errors'][0]
+        raise Exception('%s - %s' % (error.get('status'), error.get('title')))
+
+    # Use the total when the API reports one in meta. Otherwise, with one document
+    # per page, the last page number is the number of documents.
+    meta = page.get('meta') or {}
+    for key in ('total_count', 'record_count', 'total'):
+        if isinstance(meta.get(key), int):
+            return meta[key]
+
+    last = page_number((page.get('links') or {}).get('last'))
+    if last is not None and last > 1:
+        return last
+
+    return len(page.get('data') or [])
+
+
+def relative_uri(link):
+    """ Strip the scheme and host from a link so it can be signed and sent """
+
+    parts = urlsplit(link)
+    if parts.query:
+        return parts.path + '?' + parts.query
+
+    return parts.path
+
+
+class RateLimiter():
+
+    def __init__(self, rate, burst=None, lock_file=None):
+        """ Token bucket refilled at `rate` requests per second """
+
+        # burst is the most requests that can go out back to back, by default one
+        # second's worth. With lock_file every process using the same file draws from
+        # one bucket, otherwise the bucket is shared by the threads of this process.
+        if lock_file and fcntl is None:
+            raise ValueError('A rate limit lock file needs fcntl, which is not available on this platform.')
+
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.lock_file = lock_file
+        self.lock = threading.Lock()
+        self.tokens = self.burst
+        self.updated = time.time()
+
+
+    def _take(self, tokens, updated, now):
+        """ Refill the bucket, take a token and work out the wait """
+
+        # Tokens may go negative; each caller then waits its turn behind earlier ones.
+        tokens = min(self.burst, tokens + (now - updated) * self.rate) - 1
+        wait = -tokens / self.rate if tokens < 0 else 0.0
+
+        return tokens, wait
+
+
+    def reserve(self):
+        """ Take a token and return the number of seconds to wait before using it """
+
+        with self.lock:
+            now = time.time()
+
+            if not self.lock_file:
+                self.tokens, wait = self._take(self.tokens, self.updated, now)
+                self.updated = now
+                return wait
+
+            # The bucket state lives in the lock file as "<tokens> <updated>".
+            with open(self.lock_file, 'a+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    try:
+                        tokens, updated = [ float(v) for v in f.read().split() ]
+                    except ValueError:
+                        tokens, updated = self.burst, now
+
+                    tokens, wait = self._take(tokens, updated, now)
+
+                    f.seek(0)
+                    f.truncate()
+                    f.write('%f %f' % (tokens, now))
+                    f.flush()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+            return wait
+
+
+    def acquire(self):
+        """ Block until a request may be sent """
+
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+
+class StreamParser():
+
+    # Whitespace between JSON tokens, and characters that can continue a number
+    whitespace = re.compile(r'[ \t\n\r]*')
+    number_tail = re.compile(r'[0-9.eE+-]*')
+
+    def __init__(self, chunks):
+        """ Incremental reader over an iterable of byte chunks """
+
+        self.chunks = iter(chunks)
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder('UTF-8')()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+
+    def fill(self):
+        """ Read the next chunk, False at the end of the body """
+
+        if self.eof:
+            return False
+
+        # Drop what has been parsed so the buffer stays about one chunk long.
+        self.buf = self.buf[self.pos:]
+        self.pos = 0
+
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.eof = True
+            self.buf += self.utf8.decode(b'', final=True)
+        else:
+            self.buf += self.utf8.decode(chunk)
+
+        return True
+
+
+    def peek(self):
+        """ Next non-whitespace character """
+
+        while True:
+            self.pos = self.whitespace.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                raise ValueError('Unexpected end of JSON document')
+
+
+    def expect(self, chars):
+        """ Consume one of `chars` and return it """
+
+        c = self.peek()
+        if c not in chars:
+            raise ValueError('Expected %s at %r' % (' or '.join(chars), self.buf[self.pos:self.pos + 20]))
+        self.pos += 1
+
+        return c
+
+
+    def value(self):
+        """ Decode the next complete JSON value """
+
+        while True:
+            self.peek()
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if not self.fill():
+                    raise
+                continue
+
+            # A number at the very end of the buffer may continue in the next chunk.
+            if self.number_tail.match(self.buf, end).end() < len(self.buf) or not self.fill():
+                self.pos = end
+                return value
+
+
+def iter_members(chunks, members=('data', 'included')):
+    """ Yield (member, value) pairs from a JSON:API document as it is read """
+
+    # Each element of the `members` arrays is yielded as soon as it has been read, so
+    # a page is never held in memory as a whole. Other top level members such as links
+    # and meta are yielded whole.
+    parser = StreamParser(chunks)
+    parser.expect('{')
+    if parser.peek() == '}':
+        return
+
+    while True:
+        key = parser.value()
+        parser.expect(':')
+
+        if key in members and parser.peek() == '[':
+            parser.expect('[')
+            if parser.peek() == ']':
+                parser.expect(']')
+            else:
+                while True:
+                    yield key, parser.value()
+                    if parser.expect(',]') == ']':
+                        break
+        else:
+            yield key, parser.value()
+
+        if parser.expect(',}') == '}':
+            return
+
+
+class IncludedIndex():
+
+    def __init__(self, documents=None):
+        """ JSON:API included documents keyed by (type, id) """
+
+        # Build once per response, or add() each page's included list to merge pages.
+        self.documents = {}
+        self.add(documents)
+
+
+    def add(self, documents):
+        """ Index a list of included documents """
+
+        for doc in documents or []:
+            self.documents[(doc['type'], str(doc['id']))] = doc
+
+
+    def get(self, doc_type, doc_id):
+        """ Included document by type and id, None if it wasn't included """
+
+        return self.documents.get((doc_type, str(doc_id)))
+
+
+    def resolve(self, relationship):
+        """ Included documents for a relationship, a list for to-many relationships """
+
+        data = relationship.get('data')
+        if data is None:
+            return None
+
+        if isinstance(data, list):
+            return [ doc for doc in (self.get(d['type'], d['id']) for d in data) if doc is not None ]
+
+        return self.get(data['type'], data['id'])
+
+
+def relationship_targets(relationship):
+    """ (type, id) pairs a relationship points at, and whether it is to-many """
+
+    # From the linkage data when it is there, otherwise from the related link. That is
+    # either /api/v2/<type>/<id>.json or, for to-many, /api/v2/<type>.json?filter[id_in]=<ids>.
+    data = relationship.get('data')
+    if isinstance(data, list):
+        return [ (d['type'], str(d['id'])) for d in data ], True
+    if data is not None:
+        return [ (data['type'], str(data['id'])) ], False
+
+    link = (relationship.get('links') or {}).get('related')
+    if not link:
+        return [], False
+
+    parts = urlsplit(link)
+    head, _, tail = unquote(parts.path).rstrip('/').rpartition('/')
+    tail = tail.split('.')[0]
+    ids = parse_qs(parts.query).get('filter[id_in]')
+    if ids:
+        return [ (tail, i) for i in ','.join(ids).split(',') if i ], True
+    if tail.isdigit():
+        return [ (head.rpartition('/')[2], tail) ], False
+
+    return [], False
+
+
+class RelationshipResolver(IncludedIndex):
+
+    def __init__(self, api, batch_size=100, timeout=(3, 10)):
+        """ Related documents fetched in filter[id_in] batches and kept for the run """
+
+        # Instead of one GET per relationships.*.links.related, prefetch() collects the
+        # ids a page of documents points at and fetches each type batch_size at a time.
+        # Sideloaded documents can be add()ed so they are never fetched. Thread safe.
+        self.api = api
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        IncludedIndex.__init__(self)
+
+
+    def add(self, documents):
+        """ Index a list of documents, such as a page's data or included """
+
+        with self.lock:
+            IncludedIndex.add(self, documents)
+
+
+    def fetch(self, keys):
+        """ Fetch the (type, id) documents that aren't known yet """
+
+        missing = {}
+        for doc_type, doc_id in keys:
+            if (doc_type, doc_id) not in self.documents:
+                missing.setdefault(doc_type, set()).add(doc_id)
+
+        for doc_type, ids in missing.items():
+            ids = sorted(ids)
+            for i in range(0, len(ids), self.batch_size):
+                uri = '/api/v2/%s?filter[id_in]=%s' % (doc_type, ','.join(ids[i:i + self.batch_size]))
+                for page in self.api.paginate(uri, page_size=self.batch_size, timeout=self.timeout):
+                    if 'errors' in page:
+                        error = page['errors'][0]
+                        raise Exception('%s - %s' % (error.get('status'), error.get('title')))
+                    self.add(page.get('data'))
+                    self.add(page.get('included'))
+
+
+    def prefetch(self, documents, *names):
+        """ Fetch what the named relationships of every document point at """
+
+        keys = []
+        for doc in documents:
+            relationships = doc.get('relationships') or {}
+            for name in names:
+                if name in relationships:
+                    keys += relationship_targets(relationships[name])[0]
+
+        self.fetch(keys)
+
+
+    def resolve(self, relationship):
+        """ Related document, a list for to-many relationships, fetched if need be """
+
+        keys, many = relationship_targets(relationship)
+        self.fetch(keys)
+
+        if many:
+            return [ doc for doc in (self.documents.get(key) for key in keys) if doc is not None ]
+
+        return self.documents.get(keys[0]) if keys else None
+
+
+# One record per request attempt, kept in ApiHelper.attempts
+Attempt = namedtuple('Attempt', 'method uri number status error elapsed delay')
+
+
+def retry_after_seconds(value):
+    """ Seconds from a Retry-After header, None if missing or unreadable """
+
+    # Retry-After is either a number of seconds or an HTTP date.
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy():
+
+    # Methods that are safe to send twice
+    idempotent = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+    def __init__(self, max_attempts=5, base_delay=1.0, max_delay=60.0, retry_statuses=(429, 500, 502, 503, 504)):
+        """ Capped exponential backoff with full jitter """
+
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_statuses = retry_statuses
+
+
+    def retry_status(self, method, status):
+        """ Whether a response status is worth another attempt """
+
+        # A 429 is rejected before anything runs, so it is safe to repeat for any method.
+        # Other errors may have been applied already, only repeat idempotent requests.
+        if status == 429:
+            return True
+
+        return method in self.idempotent and status in self.retry_statuses
+
+
+    def retry_error(self, method, connect_failed):
+        """ Whether a connection error or timeout is worth another attempt """
+
+        # A request that never reached the server can always be repeated, resets and
+        # read timeouts only when the method is idempotent.
+        return connect_failed or method in self.idempotent
+
+
+    def delay(self, number, retry_after=None):
+        """ Seconds to wait after attempt `number` """
+
+        if retry_after is not None:
+            return retry_after
+
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (number - 1)))
+
+
 class ApiHelper():
 
-    def __init__(self):
-        """ Environment variables """
+    # Process-wide instance handed out by shared()
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, pool_size=10, rate_limit=None, rate_limit_file=None, retry_policy=None, cache=None):
+        """ Environment variables and a pooled keep-alive session """
 
         # API keys from shell env
         self.pub_key = os.environ["ESP_ACCESS_KEY_ID"]
         self.secret_key = os.environ["ESP_SECRET_ACCESS_KEY"]
+        self.signer = RequestSigner(self.pub_key, self.secret_key)
+
+        # One long-lived session so TCP and TLS connections are reused between calls.
+        # pool_size is the number of connections kept open to the API, set it to the
+        # number of threads sharing this helper.
+        # http://docs.python-requests.org/en/latest/user/advanced/#transport-adapters
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        # Optional client side rate limit in requests per second, so we stay under the
+        # ESP quota instead of waiting out 429s. Give the same rate_limit_file to every
+        # process that should share the limit.
+        self.rate_limiter = None
+        if rate_limit:
+            self.rate_limiter = RateLimiter(rate_limit, lock_file=rate_limit_file)
+
+        # Retries for 429s, 5xx and connection errors, with the timing of every attempt
+        # kept in self.attempts (most recent 1000).
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.attempts = deque(maxlen=1000)
+
+        # Optional ResponseCache for GET requests, see response_cache.py
+        self.cache = cache
+
+
+    @classmethod
+    def shared(cls, **kwargs):
+        """ Return the helper shared by every caller in this process """
+
+        # kwargs are only used the first time, when the shared helper is built.
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls(**kwargs)
+
+        return cls._shared
+
+
+    def close(self):
+        """ Close pooled connections """
+
+        self.session.close()
+
+
+    def send(self, method, uri, data, timeout, headers=None, stream=False):
+        """ Send a signed request, retrying per the retry policy, and return the response """
+
+        policy = self.retry_policy
+        for number in range(1, policy.max_attempts + 1):
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+
+            # Signed per attempt so every retry carries a current Date.
+            signed = self.signer.sign(method, uri, data)
+            signed.update(headers or {})
+
+            # Using requests, sent over the pooled session
+            # http://docs.python-requests.org/en/latest/user/advanced/
+
+            r = requests.Request(method, api_url+uri, data=data, headers=signed)
+            p = r.prepare()
+
+            started = time.time()
+            try:
+                ask = self.session.send(p, timeout=timeout, stream=stream)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                elapsed = time.time() - started
+                reason = getattr(e.args[0], 'reason', None) if e.args else None
+                connect_failed = isinstance(e, requests.exceptions.ConnectTimeout) or isinstance(reason, NewConnectionError)
+
+                if number == policy.max_attempts or not policy.retry_error(method, connect_failed):
+                    self.attempts.append(Attempt(method, uri, number, None, type(e).__name__, elapsed, 0.0))
+                    raise
+
+                delay = policy.delay(number)
+                self.attempts.append(Attempt(method, uri, number, None, type(e).__name__, elapsed, delay))
+                time.sleep(delay)
+                continue
+
+            elapsed = time.time() - started
+            if number < policy.max_attempts and policy.retry_status(method, ask.status_code):
+                delay = policy.delay(number, retry_after_seconds(ask.headers.get('Retry-After')))
+                self.attempts.append(Attempt(method, uri, number, ask.status_code, None, elapsed, delay))
+                ask.close()
+                time.sleep(delay)
+                continue
+
+            self.attempts.append(Attempt(method, uri, number, ask.status_code, None, elapsed, 0.0))
+            return ask
 
 
     def api_call(self, method, uri, data, timeout):
         """ API call """
 
-        # ESP API endpoint - http://api-docs.evident.io/
-        url = 'https://api.evident.io'
+        # Fresh cached responses skip the network, stale ones are revalidated.
+        cached = None
+        if self.cache and method == 'GET':
+            cached = self.cache.lookup(uri)
+            if cached and cached.fresh:
+                return json.loads(cached.body)
 
-        # Uses the RFC-1123 spec. Note: Must be in the GMT timezone.
-        now   = datetime.now()
-        stamp = mktime(now.timetuple())
-        dated = format_date_time(stamp)
+        ask = self.send(method, uri, data, timeout, headers=cached.validators if cached else None)
 
-        # The Content-MD5 header should include a MD5 base64 hexdigest of the request body.
-        hex  = hashlib.md5(data.encode('UTF-8')).hexdigest()
-        body = codecs.encode(codecs.decode(hex, 'hex'), 'base64').decode().rstrip('\n')
+        if cached and ask.status_code == 304:
+            self.cache.refresh(uri)
+            return json.loads(cached.body)
 
-        # Create a canonical string using your HTTP headers containing the HTTP method,
-        # content-type, content-MD5, request URI and the timestamp.
-        canonical = '%s,%s,%s,%s,%s' % (method, 'application/vnd.api+json', body, uri, dated)
+        if self.cache and method == 'GET' and ask.status_code == 200:
+            self.cache.store(uri, ask.content, ask.headers)
 
-        # Convert from string to bytes.
-        secret = bytes(self.secret_key, 'UTF-8')
-        canonical = bytes(canonical, 'UTF-8')
+        # Error pages from a proxy or load balancer aren't JSON:API documents.
+        try:
+            response = ask.json()
+        except ValueError:
+            response = { 'errors': [ { 'status': str(ask.status_code), 'title': ask.reason } ] }
 
-        # Use the HMAC-SHA1 algorithm to encode the string with your secret key.
-        hashed = hmac.new(secret, canonical, hashlib.sha1)
-        encoded = base64.b64encode(hashed.digest())
-        auth = str(encoded, 'UTF-8')
+        return response
 
-        # Add an Authorization header with the ‘APIAuth’, the public key, and the encoded
-        # canonical string.
 
-        headers = { 'Date'          : '%s' % (dated),
-                    'Content-MD5'   : '%s' % (body),
-                    'Content-Type'  : 'application/vnd.api+json',
-                    'Accept'        : 'application/vnd.api+json',
-                    'Authorization' : 'APIAuth %s:%s' % (self.pub_key, auth) }
+    def count(self, uri, timeout=(3, 10)):
+        """ Number of documents in a JSON:API collection """
 
-        # Using requests
-        # http://docs.python-requests.org/en/latest/user/advanced/
+        # Fetches a single one-document page, so counting never downloads the collection.
+        return collection_count(self.api_call('GET', page_uri(uri, 1, 1), '', timeout))
 
-        r = requests.Request(method, url+uri, data=data, headers=headers)
-        p = r.prepare()
-        s = requests.Session()
-        ask = s.send(p, timeout=timeout)
-        response = ask.json()
 
-        return response
+    def paginate(self, uri, page_size=100, timeout=(3, 10), workers=4):
+        """ Yield every page of a JSON:API collection, in order """
+
+        # Page N+1 is fetched in the background while the caller handles page N. When
+        # the first page carries links.last, the remaining pages are fetched by a pool of
+        # workers instead, at most 2 * workers pages ahead of the caller.
+        executor = ThreadPoolExecutor(max_workers=workers)
+        window = deque()
+
+        def fetch(page_link):
+            return executor.submit(self.api_call, 'GET', page_link, '', timeout)
+
+        try:
+            page = self.api_call('GET', page_uri(uri, 1, page_size), '', timeout)
+            links = page.get('links') or {}
+            last = page_number(links.get('last'))
+
+            if last is not None:
+                numbers = iter(range(2, last + 1))
+                for n in numbers:
+                    window.append(fetch(page_uri(uri, n, page_size)))
+                    if len(window) >= 2 * workers:
+                        break
+                yield page
+
+                while window:
+                    page = window.popleft().result()
+                    n = next(numbers, None)
+                    if n is not None:
+                        window.append(fetch(page_uri(uri, n, page_size)))
+                    yield page
+            else:
+                while True:
+                    next_link = links.get('next')
+                    if next_link:
+                        window.append(fetch(relative_uri(next_link)))
+                    yield page
+
+                    if not window:
+                        break
+                    page = window.popleft().result()
+                    links = page.get('links') or {}
+        finally:
+            # The caller may stop early, drop whatever is still queued.
+            for future in window:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+
+    def stream(self, uri, timeout=(3, 10), members=('data', 'included')):
+        """ Yield (member, value) pairs from a GET response as it arrives """
 
+        # For large pages: every data[] and included[] element is parsed straight off the
+        # socket instead of buffering the body and then the whole document.
+        ask = self.send('GET', uri, '', timeout, stream=True)
+        try:
+            for member in iter_members(ask.iter_content(chunk_size=64 * 1024), members):
+                yield member
+        finally:
+            ask.close()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, 2014, 2015, 2016, 2017. Evident.io (Evident). All Rights Reserved. 
+# 
+#   Evident.io shall retain all ownership of all right, title and interest in and to 
+#   the Licensed Software, Documentation, Source Code, Object Code, and API's ("Deliverables"), 
+#   including (a) all information and technology capable of general application to Evident.io's
+#   customers; and (b) any works created by Evident.io prior to its commencement of any
+#   Services for Customer.
+# 
+# Upon receipt of all fees, expenses and taxes due in respect of the relevant Services, 
+#   Evident.io grants the Customer a perpetual, royalty-free, non-transferable, license to 
+#   use, copy, configure and translate any Deliverable solely for internal business operations
+#   of the Customer as they relate to the Evident.io platform and products, and always
+#   subject to Evident.io's underlying intellectual property rights.
+# 
+# IN NO EVENT SHALL EVIDENT.IO BE LIABLE TO ANY PARTY FOR DIRECT, INDIRECT, SPECIAL, 
+#   INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING LOST PROFITS, ARISING OUT OF 
+#   THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION, EVEN IF EVIDENT.IO HAS BEEN HAS BEEN
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# EVIDENT.IO SPECIFICALLY DISCLAIMS ANY WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE. 
+#   THE SOFTWARE AND ACCOMPANYING DOCUMENTATION, IF ANY, PROVIDED HEREUNDER IS PROVIDED "AS IS". 
+#   EVIDENT.IO HAS NO OBLIGATION TO PROVIDE MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS,
+#   OR MODIFICATIONS.
+# 
+# ---
+#
+# Asyncio API helper
+#
+# Same APIAuth signing as ApiHelper, but requests are awaited so a script can keep
+# many of them in flight. A per-client semaphore bounds the number of concurrent requests.
+#
+# Example:
+#
+#   async with AsyncApiHelper(concurrency=25) as api:
+#       responses = await asyncio.gather(*[ api.get(uri) for uri in uris ])
+#
+
+from api_helper import api_url, collection_count, page_uri, retry_after_seconds, Attempt, RateLimiter, RetryPolicy
+
+from request_signer import RequestSigner
+from collections import deque
+
+import asyncio
+import aiohttp
+import json
+import yarl
+import time
+import os
+
+class AsyncApiHelper():
+
+    def __init__(self, concurrency=20, rate_limit=None, rate_limit_file=None, retry_policy=None, cache=None):
+        """ Environment variables, the in-flight request limit and rate limit """
+
+        # API keys from shell env
+        self.pub_key = os.environ["ESP_ACCESS_KEY_ID"]
+        self.secret_key = os.environ["ESP_SECRET_ACCESS_KEY"]
+        self.signer = RequestSigner(self.pub_key, self.secret_key)
+
+        # The session and semaphore are created on first use so they bind to the
+        # running event loop.
+        self.concurrency = concurrency
+        self.semaphore = None
+        self.session = None
+
+        # Optional requests per second limit, see ApiHelper.
+        self.rate_limiter = None
+        if rate_limit:
+            self.rate_limiter = RateLimiter(rate_limit, lock_file=rate_limit_file)
+
+        # Retries and per-attempt timing, see ApiHelper.
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.attempts = deque(maxlen=1000)
+
+        # Optional ResponseCache for GET requests, see response_cache.py
+        self.cache = cache
+
+
+    async def __aenter__(self):
+        return self
+
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+    async def close(self):
+        """ Close pooled connections """
+
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+    def _open(self):
+        """ Create the session and semaphore """
+
+        if self.session is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+            connector = aiohttp.TCPConnector(limit=self.concurrency)
+            self.session = aiohttp.ClientSession(connector=connector)
+
+
+    async def api_call(self, method, uri, data, timeout):
+        """ API call """
+
+        self._open()
+
+        # Accept the same (connect, read) tuple that ApiHelper takes.
+        if isinstance(timeout, tuple):
+            timeout = aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])
+        else:
+            timeout = aiohttp.ClientTimeout(total=timeout)
+
+        # Fresh cached responses skip the network, stale ones are revalidated.
+        cached = None
+        if self.cache and method == 'GET':
+            cached = self.cache.lookup(uri)
+            if cached and cached.fresh:
+                return json.loads(cached.body)
+
+        policy = self.retry_policy
+        for number in range(1, policy.max_attempts + 1):
+
+            # The semaphore is held for one attempt, not while backing off.
+            async with self.semaphore:
+                if self.rate_limiter:
+                    await asyncio.sleep(self.rate_limiter.reserve())
+
+                # Sign once a slot is free so the Date header is current when the request goes out.
+                headers = self.signer.sign(method, uri, data)
+                if cached:
+                    headers.update(cached.validators)
+
+                # The uri is sent exactly as it was signed.
+                target = yarl.URL(api_url + uri, encoded=True)
+
+                started = time.time()
+                error = None
+                try:
+                    async with self.session.request(method, target, data=data, headers=headers, timeout=timeout) as ask:
+                        status = ask.status
+                        retry_after = retry_after_seconds(ask.headers.get('Retry-After'))
+                        retry = number < policy.max_attempts and policy.retry_status(method, status)
+                        if not retry:
+                            content = await ask.read()
+                            response_headers = ask.headers
+                            reason = ask.reason
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    error = e
+
+            elapsed = time.time() - started
+            if error is not None:
+                connect_failed = isinstance(error, aiohttp.ClientConnectorError)
+                if number == policy.max_attempts or not policy.retry_error(method, connect_failed):
+                    self.attempts.append(Attempt(method, uri, number, None, type(error).__name__, elapsed, 0.0))
+                    raise error
+
+                delay = policy.delay(number)
+                self.attempts.append(Attempt(method, uri, number, None, type(error).__name__, elapsed, delay))
+                await asyncio.sleep(delay)
+                continue
+
+            if retry:
+                delay = policy.delay(number, retry_after)
+                self.attempts.append(Attempt(method, uri, number, status, None, elapsed, delay))
+                await asyncio.sleep(delay)
+                continue
+
+            self.attempts.append(Attempt(method, uri, number, status, None, elapsed, 0.0))
+
+            if cached and status == 304:
+                self.cache.refresh(uri)
+                return json.loads(cached.body)
+
+            if self.cache and method == 'GET' and status == 200:
+                self.cache.store(uri, content, response_headers)
+
+            # Error pages from a proxy or load balancer aren't JSON:API documents.
+            try:
+                response = json.loads(content)
+            except ValueError:
+                response = { 'errors': [ { 'status': str(status), 'title': reason } ] }
+
+            return response
+
+
+    async def get(self, uri, timeout=(3, 10)):
+        """ GET request """
+
+        return await self.api_call('GET', uri, '', timeout)
+
+
+    async def post(self, uri, data, timeout=(3, 10)):
+        """ POST request """
+
+        return await self.api_call('POST', uri, data, timeout)
+
+
+    async def patch(self, uri, data, timeout=(3, 10)):
+        """ PATCH request """
+
+        return await self.api_call('PATCH', uri, data, timeout)
+
+
+    async def delete(self, uri, data='', timeout=(3, 10)):
+        """ DELETE request """
+
+        return await self.api_call('DELETE', uri, data, timeout)
+
+
+    async def count(self, uri, timeout=(3, 10)):
+        """ Number of documents in a JSON:API collection """
+
+        return collection_count(await self.api_call('GET', page_uri(uri, 1, 1), '', timeout))
@@ -29,7 +29,8 @@
 # Description:
 #
 # This script dumps an ESP audit report to a csv formatted file called,
-# "esp_audit_report_YYYYMMDDTHHMMSS.csv" in the same directory that the script is executed in.
+# "esp_audit_report_YYYYMMDDTHHMMSS.csv" in the same directory that the script is executed in,
+# or to a parquet dataset partitioned by day (see output_format below).
 #
 # Requirements:
 #
@@ -41,165 +42,320 @@
 #   export ESP_ACCESS_KEY_ID=<your_access_key>
 #   export ESP_SECRET_ACCESS_KEY=<your_secret_access_key>
 #
-# Set the number of log entries to search and report on:
+# * numpy
+#   `pip install numpy`
+#
+# * pyarrow, only for output_format = 'parquet'
+#   `pip install pyarrow`
+#
+# Set the time window to report on, and how to page through it:
 #
-no_of_pages = 5     # search 250 log enteries
 no_of_days  = 1     # return the last 24 hrs of activity
+page_size   = 100   # log entries per request, up to 100
+no_of_pages = None  # or stop after this many pages, e.g. 5 for the last 500 entries at most
+gzip_output = False # write esp_audit_report_YYYYMMDDTHHMMSS.csv.gz instead
 # --
-#no_of_pages = 10    # search 500 log enteries
 #no_of_days  = 3     # return the last 3 days of activity
 
+# Or write a parquet dataset, the directory esp_audit_report_YYYYMMDDTHHMMSS/ with one
+# date=YYYY-MM-DD/ partition per day of created_at. Columnar and much smaller than csv,
+# for querying months of history with pandas, Spark, Athena or DuckDB. Needs pyarrow,
+# `pip install pyarrow`.
+#
+output_format = 'csv'   # or 'parquet'
 
-from wsgiref.handlers import format_date_time
-from datetime import datetime
-from time import mktime
+# Or sync incrementally: every run appends the entries created since the last run to one
+# csv file, however many pages that takes. The last entry written (id and created_at) is
+# kept in the state file. The first run starts no_of_days back. A sync_csv_file name
+# ending in .gz is gzipped. With output_format = 'parquet' every run adds a part file per
+# day to the sync_dataset directory instead.
+#
+incremental     = False
+sync_csv_file   = 'esp_audit_log.csv'
+sync_dataset    = 'esp_audit_log'
+sync_state_file = 'esp_audit_log_state.json'
 
-import hashlib
-import codecs
-import hmac
-import base64
-import requests
-import os
-import csv
+# Or backfill a long window, e.g. no_of_days = 90 for a compliance export: the pages of
+# the window are fetched by a pool of workers and the report is written oldest first.
+#
+backfill = False
+workers  = 8
 
 
-# API keys from shell env
-#
-pub_key = os.environ["ESP_ACCESS_KEY_ID"]
-secret_key = os.environ["ESP_SECRET_ACCESS_KEY"]
-# or...
-#pub_key = <your_esp_access_key_id>
-#secret_key = <your_esp_secret_access_key>
+from api_helper import ApiHelper
+from csv_helper import write_csv
+from datetime import datetime, timedelta, timezone
+from timestamp_helper import parse_time, parse_times, to_datetime64
 
+import itertools
+import json
+import os
 
-def api_call(method, uri, data, timeout):
-    """ API call """
 
-    # ESP API endpoint - http://api-docs.evident.io/
-    url = 'https://api.evident.io'
+# Audit log created_at format, always UTC
+time_format = '%Y-%m-%dT%H:%M:%S.000Z'
 
-    # Uses the RFC-1123 spec. Note: Must be in the GMT timezone.
-    now   = datetime.now()
-    stamp = mktime(now.timetuple())
-    dated = format_date_time(stamp)
+head = [ 'id', 'platform', 'created_at', 'organization_id', 'organization_name', 'user_email', 'user_ip', 'access_denied', 'successful', 'action', 'item_type', 'item_id' ]
 
-    # The Content-MD5 header should include a MD5 base64 hexdigest of the request body.
-    hex  = hashlib.md5(data.encode('UTF-8')).hexdigest()
-    body = codecs.encode(codecs.decode(hex, 'hex'), 'base64').decode().rstrip('\n')
+# Parquet column types, strings otherwise. The dictionary columns repeat a handful of values.
+parquet_types      = { 'created_at': 'timestamp', 'access_denied': 'bool', 'successful': 'bool' }
+parquet_dictionary = [ 'platform', 'organization_name', 'user_email', 'action', 'item_type' ]
 
-    # Create a canonical string using your HTTP headers containing the HTTP method,
-    # content-type, content-MD5, request URI and the timestamp.
-    canonical = '%s,%s,%s,%s,%s' % (method, 'application/vnd.api+json', body, uri, dated)
 
-    # Convert from string to bytes.
-    secret = bytes(secret_key, 'UTF-8')
-    canonical = bytes(canonical, 'UTF-8')
+def organization(response):
+    """ Organization id and name from a page's included organization """
 
-    # Use the HMAC-SHA1 algorithm to encode the string with your secret key.
-    hashed = hmac.new(secret, canonical, hashlib.sha1)
-    encoded = base64.b64encode(hashed.digest())
-    auth = str(encoded, 'UTF-8')
+    try:
+        org_id   = response['included'][0]['id']
+        org_name = response['included'][0]['attributes']['name']
+    except (KeyError, IndexError):
+        org_id = 'not found'; org_name = 'not found'
 
-    # Add an Authorization header with the ‘APIAuth’, the public key, and the encoded
-    # canonical string.
+    return org_id, org_name
 
-    headers = { 'Date'          : '%s' % (dated),
-                'Content-MD5'   : '%s' % (body),
-                'Content-Type'  : 'application/vnd.api+json',
-                'Accept'        : 'application/vnd.api+json',
-                'Authorization' : 'APIAuth %s:%s' % (pub_key, auth) }
 
-    # Using requests
-    # http://docs.python-requests.org/en/latest/user/advanced/
+def audit_log_row(log, org_id, org_name):
+    """ Report row of an audit log entry """
 
-    r = requests.Request(method, url+uri, data=data, headers=headers)
-    p = r.prepare()
-    s = requests.Session()
-    ask = s.send(p, timeout=timeout)
-    response = ask.json()
+    return {
+      'id'                 : log['id'],
+      'platform'           : log['attributes']['platform'],
+      'created_at'         : log['attributes']['created_at'],
+      'organization_id'    : org_id,
+      'organization_name'  : org_name,
+      'user_email'         : log['attributes']['user_email'],
+      'user_ip'            : log['attributes']['user_ip'],
+      'access_denied'      : log['attributes']['access_denied'],
+      'successful'         : log['attributes']['successful'],
+      'action'             : log['attributes']['action'],
+      'item_type'          : log['attributes']['item_type'],
+      'item_id'            : log['attributes']['item_id']
+    }
 
-    return response
+
+def created_times(logs):
+    """ created_at of a page of entries, as one datetime64 array """
+
+    return parse_times([ log['attributes']['created_at'] for log in logs ])
 
 
 def create_audit_report(today):
-    """ Build an audit logs report """
+    """ Build an audit logs report, one row at a time """
 
-    method = 'GET'
-    data = ''
+    api = ApiHelper.shared()
     timeout = (3, 10)
 
+    # The window is filtered on the server. Entries are newest first, so paging also
+    # stops at the first older entry in case the filter is ignored. New entries go on
+    # the front of the list and push every row one place down, so the window ends at
+    # today and the page contents hold still. Pages are read one after another all the
+    # same: should a shift happen, a row is read twice rather than skipped.
+    since = today - timedelta(days=no_of_days)
+    window = to_datetime64(since)
+    uri = '/api/v2/audit_logs.json?include=organization&filter[created_at_gte]=%s&filter[created_at_lte]=%s' % (since.strftime(time_format), today.strftime(time_format))
+
+    seen = set() # skip the repeats
+    for n, response in enumerate(api.paginate(uri, page_size=page_size, timeout=timeout, workers=1)):
+        if 'errors' in response:
+            raise Exception('%s - %s' % (response['errors'][0]['status'], response['errors'][0]['title']))
+
+        org_id, org_name = organization(response)
+
+        logs = response.get('data') or []
+        in_window = created_times(logs) > window
+        for log, keep in zip(logs, in_window):
+            if not keep:
+                break
+
+            if log['id'] not in seen:
+                seen.add(log['id'])
+                yield audit_log_row(log, org_id, org_name)
+
+        if not in_window.all() or n + 1 == no_of_pages:
+            break
+
+
+def backfill_audit_report(today):
+    """ Build an audit logs report with parallel page fetches, oldest first """
+
+    api = ApiHelper.shared(pool_size=max(10, workers))
+    timeout = (3, 30)
+
+    # The first page's links.last gives the page range, which paginate() then fetches
+    # with `workers` requests in flight, in no fixed order. New entries go on the front
+    # of the list and would push rows onto pages already read, so the window ends at
+    # today and the page contents hold still.
+    since = today - timedelta(days=no_of_days)
+    window = to_datetime64(since)
+    uri = '/api/v2/audit_logs.json?include=organization&filter[created_at_gte]=%s&filter[created_at_lte]=%s' % (since.strftime(time_format), today.strftime(time_format))
+
+    rows = {}
+    for n, response in enumerate(api.paginate(uri, page_size=page_size, timeout=timeout, workers=workers)):
+        if 'errors' in response:
+            raise Exception('%s - %s' % (response['errors'][0]['status'], response['errors'][0]['title']))
+
+        org_id, org_name = organization(response)
+        output = response.get('data') or []
+        times = created_times(output)
+        for log, created_at in zip(output, times):
+            if created_at > window:
+                rows[log['id']] = (created_at, int(log['id']), audit_log_row(log, org_id, org_name))
+
+        # Entries are newest first, a page that ends out of the window is the last one
+        if (output and not times[-1] > window) or n + 1 == no_of_pages:
+            break
+
+    # Keyed by id above, so a row is written once should the server ignore the bound
+    # and repeat it on the next page. Reassemble in created_at order.
+    for created_at, log_id, row in sorted(rows.values(), key=lambda r: (r[0], r[1])):
+        yield row
+
+
+def load_state(state_file_name):
+    """ High-water mark of the last sync, None before the first one """
+
+    if not os.path.exists(state_file_name):
+        return None
+
+    with open(state_file_name) as f:
+        return json.load(f)
+
+
+def save_state(state_file_name, state):
+    """ Replace the state file, never leaving a partial one behind """
+
+    with open(state_file_name + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(state_file_name + '.tmp', state_file_name)
+
+
+def sync_audit_logs(state, today):
+    """ Audit log entries newer than the high-water mark, newest first, and the new mark """
+
+    api = ApiHelper.shared()
+    timeout = (3, 10)
+
+    # Entries are newest first, stop at the first one that was already written. Before
+    # the first sync, stop at the first one older than no_of_days. The server filters
+    # out anything older than the mark's created_at as well.
+    if state:
+        mark = (parse_time(state['created_at']), int(state['id']))
+    else:
+        mark = (today - timedelta(days=no_of_days), 0)
+
+    # New entries go on the front of the list and push every row one place down. The
+    # window ends when the sync starts so the pages hold still, anything newer is left
+    # for the next sync. Pages are read one after another all the same: should a shift
+    # happen, a row is read twice rather than skipped.
     report = []
-    for n in range(no_of_pages):
-        uri = '/api/v2/audit_logs.json?include=organization&page[number]=%d&page[size]=50' % (n + 1)
-        response = api_call(method, uri, data, timeout)
-
-        try:
-            org_id   = response['included'][0]['id']
-            org_name = response['included'][0]['attributes']['name']
-        except KeyError:
-            org_id = 'not found'; org_name = 'not found'
-
-        try:
-            output = response['data']
-        except KeyError:
-            pass
-        else:
-            for log in output:
-                created_at = datetime.strptime(log['attributes']['created_at'], '%Y-%m-%dT%H:%M:%S.000Z')
-                delta = today - created_at
-                if delta.days >= no_of_days:
-                    continue
-
-                report_info = {
-                  'id'                 : log['id'],
-                  'platform'           : log['attributes']['platform'],
-                  'created_at'         : log['attributes']['created_at'],
-                  'organization_id'    : org_id,
-                  'organization_name'  : org_name,
-                  'user_email'         : log['attributes']['user_email'],
-                  'user_ip'            : log['attributes']['user_ip'],
-                  'access_denied'      : log['attributes']['access_denied'],
-                  'successful'         : log['attributes']['successful'],
-                  'action'             : log['attributes']['action'],
-                  'item_type'          : log['attributes']['item_type'],
-                  'item_id'            : log['attributes']['item_id']
-                }
-
-                report.append(report_info)
-
-    return report
+    seen = set() # skip the repeats
+    uri = '/api/v2/audit_logs.json?include=organization&filter[created_at_gte]=%s&filter[created_at_lte]=%s' % (mark[0].strftime(time_format), today.strftime(time_format))
+    mark = (to_datetime64(mark[0]), mark[1])
+    for response in api.paginate(uri, page_size=page_size, timeout=timeout, workers=1):
+        if 'errors' in response:
+            raise Exception('%s - %s' % (response['errors'][0]['status'], response['errors'][0]['title']))
+
+        org_id, org_name = organization(response)
+        done = False
+        logs = response.get('data', [])
+        for log, created_at in zip(logs, created_times(logs)):
+            if (created_at, int(log['id'])) <= mark:
+                done = True
+                break
+            if log['id'] not in seen:
+                seen.add(log['id'])
+                report.append(audit_log_row(log, org_id, org_name))
+
+        if done or not response.get('data'):
+            break
+
+    state = { 'id': report[0]['id'], 'created_at': report[0]['created_at'] } if report else state
+
+    return report, state
 
 
 def create_csv_file(csv_file_name, report):
-    """ Create csv formatted file """
-
-    if report:
-        try:
-            with open(csv_file_name, 'w') as f:
-                head = [ 'id', 'platform', 'created_at', 'organization_id', 'organization_name', 'user_email', 'user_ip', 'access_denied', 'successful', 'action', 'item_type', 'item_id' ]
-                writer = csv.DictWriter(f, fieldnames=head)
-                writer.writeheader()
-                for row in report:
-                    writer.writerow(row)
-        except:
-            pass
-
-    if os.path.exists(csv_file_name) == True and os.stat(csv_file_name).st_size > 0:
-        result = 'Success: Created ESP csv audit report, ' + csv_file_name +'.'
+    """ Create csv formatted file, streaming the rows in as they are built """
+
+    # No file for an empty report
+    writer = None
+    error = None
+    try:
+        rows = iter(report)
+        first = next(rows, None)
+        if first:
+            writer = write_csv(csv_file_name, head, itertools.chain([first], rows))
+    except Exception as e:
+        # write_csv has removed the partial file
+        error = e
+
+    if writer and os.path.exists(csv_file_name) == True and os.stat(csv_file_name).st_size > 0:
+        result = 'Success: Created ESP csv audit report, %s (%d rows, %d bytes).' % (csv_file_name, writer.rows, writer.bytes)
     else:
         result = 'Error: Failed to create csv file, ' + csv_file_name +'.'
+        if error:
+            result += ' ' + str(error)
 
     return result
 
 
+def create_parquet_dataset(dataset, report, part_name=None):
+    """ Write a parquet dataset partitioned by created_at date """
+
+    # Imported here so csv output works without pyarrow
+    from parquet_helper import write_parquet
+
+    writer = write_parquet(dataset, head, report, types=parquet_types, dictionary=parquet_dictionary, part_name=part_name)
+
+    if writer.rows == 0:
+        return 'Error: No audit log entries to write to ' + dataset + '.'
+
+    return 'Success: Wrote ESP audit report to parquet dataset, %s (%d rows, %d partitions, %d bytes).' % (dataset, writer.rows, len(writer.files), writer.bytes)
+
+
+def append_csv_file(csv_file_name, report):
+    """ Append rows to a csv formatted file, oldest first """
+
+    writer = write_csv(csv_file_name, head, reversed(report), append=True)
+
+    return 'Success: Appended %d entries to ESP csv audit log, %s (%d bytes).' % (writer.rows, csv_file_name, writer.bytes)
+
+
 def main(csv_file_name):
     """ Do the work... """
 
-    today  = datetime.now()
-    csv_file_name = csv_file_name + '_' + today.strftime("%Y%m%dT%H%M%S") + '.csv'
+    # created_at is UTC, so is the window. The file names keep the local time.
+    today  = datetime.now(timezone.utc).replace(tzinfo=None)
+    stamp  = datetime.now().strftime("%Y%m%dT%H%M%S")
+
+    if incremental:
+        state = load_state(sync_state_file)
+        report, state = sync_audit_logs(state, today)
+        if output_format == 'parquet' and not report:
+            result = 'Success: No new ESP audit log entries for parquet dataset, ' + sync_dataset + '.'
+        elif output_format == 'parquet':
+            result = create_parquet_dataset(sync_dataset, reversed(report), 'part-%s.parquet' % (stamp))
+        else:
+            result = append_csv_file(sync_csv_file, report)
+
+        # Only move the mark once the rows are on disk
+        if state:
+            save_state(sync_state_file, state)
+
+        print(result)
+        return
+
+    csv_file_name = csv_file_name + '_' + stamp
     
-    report = create_audit_report(today)
-    result = create_csv_file(csv_file_name, report)
+    if backfill:
+        report = backfill_audit_report(today)
+    else:
+        report = create_audit_report(today)
+
+    if output_format == 'parquet':
+        result = create_parquet_dataset(csv_file_name, report)
+    else:
+        result = create_csv_file(csv_file_name + ('.csv.gz' if gzip_output else '.csv'), report)
 
     print(result)
 
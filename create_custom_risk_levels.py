@@ -10,6 +10,7 @@ import base64
 import cStringIO
 import hmac
 import time
+import os
 
 #=== Description ===
 # Update a list of External Accounts with the same set of Signature Custom Risk Levels.
@@ -50,7 +51,7 @@ NUM_OF_SIGS = 2 # In hundreds
 # Process API requests
 def call_api(action, url, data, count = 0):
     # Construct ESP API URL
-    ev_create_url = 'https://api.evident.io%s' % (url)
+    ev_create_url = '%s%s' % (os.environ.get('ESP_API_URL', 'https://api.evident.io'), url)
     
     # Create md5 hash of body
     m = md5.new()
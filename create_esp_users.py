@@ -79,7 +79,7 @@ def api_call(method, uri, data, timeout):
     """ API call """
 
     # ESP API endpoint - http://api-docs.evident.io/
-    url = 'https://api.evident.io'
+    url = os.environ.get('ESP_API_URL', 'https://api.evident.io')
 
     # Uses the RFC-1123 spec. Note: Must be in the GMT timezone.
     now   = datetime.now()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, 2014, 2015, 2016, 2017. Evident.io (Evident). All Rights Reserved. 
+# 
+#   Evident.io shall retain all ownership of all right, title and interest in and to 
+#   the Licensed Software, Documentation, Source Code, Object Code, and API's ("Deliverables"), 
+#   including (a) all information and technology capable of general application to Evident.io's
+#   customers; and (b) any works created by Evident.io prior to its commencement of any
+#   Services for Customer.
+# 
+# Upon receipt of all fees, expenses and taxes due in respect of the relevant Services, 
+#   Evident.io grants the Customer a perpetual, royalty-free, non-transferable, license to 
+#   use, copy, configure and translate any Deliverable solely for internal business operations
+#   of the Customer as they relate to the Evident.io platform and products, and always
+#   subject to Evident.io's underlying intellectual property rights.
+# 
+# IN NO EVENT SHALL EVIDENT.IO BE LIABLE TO ANY PARTY FOR DIRECT, INDIRECT, SPECIAL, 
+#   INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING LOST PROFITS, ARISING OUT OF 
+#   THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION, EVEN IF EVIDENT.IO HAS BEEN HAS BEEN
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# EVIDENT.IO SPECIFICALLY DISCLAIMS ANY WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE. 
+#   THE SOFTWARE AND ACCOMPANYING DOCUMENTATION, IF ANY, PROVIDED HEREUNDER IS PROVIDED "AS IS". 
+#   EVIDENT.IO HAS NO OBLIGATION TO PROVIDE MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS,
+#   OR MODIFICATIONS.
+# 
+#
+# Streaming csv output for the report scripts
+#
+# Report builders yield one row at a time as API pages arrive. CsvWriter writes each row
+# out as soon as it is produced instead of collecting the report in a list first, so
+# memory stays flat however many rows there are. It counts rows and bytes written, and
+# gzips the output when asked to or when the file name ends in .gz.
+#
+# Rows are written to file_name.tmp, which replaces file_name once the writer is closed.
+# Should building the rows fail part way, e.g. on an API error for a later page, the
+# partial file is removed, and an append is cut back to where it started.
+#
+# Usage:
+#
+#   with CsvWriter('report.csv.gz', head) as writer:
+#       writer.writerows(create_report())
+#   print(writer.rows, writer.bytes)
+#
+
+import gzip
+import csv
+import io
+import os
+
+
+class CsvWriter():
+
+    def __init__(self, file_name, fieldnames, compress=None, append=False):
+        """ csv.DictWriter over a plain or gzip file, counting what is written """
+
+        self.file_name = file_name
+        self.compress = file_name.endswith('.gz') if compress is None else compress
+
+        # Appending to a gzip file adds a gzip member, which readers treat as one stream.
+        header = not (append and os.path.exists(file_name) and os.path.getsize(file_name) > 0)
+        self.path = file_name if append else file_name + '.tmp'
+        self.raw = open(self.path, 'ab' if append else 'wb')
+        self.start = self.raw.tell()
+        self.gzip = gzip.GzipFile(fileobj=self.raw, mode='wb') if self.compress else None
+        self.text = io.TextIOWrapper(self.gzip or self.raw, encoding='UTF-8', newline='')
+        self.writer = csv.DictWriter(self.text, fieldnames=fieldnames)
+
+        self.rows = 0
+        self.closed_bytes = None
+        if header:
+            self.writer.writeheader()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+    @property
+    def bytes(self):
+        """ Bytes on disk written so far, compressed if the output is """
+
+        if self.closed_bytes is not None:
+            return self.closed_bytes
+
+        return self.raw.tell() - self.start
+
+
+    def writerow(self, row):
+        """ Write one row """
+
+        self.writer.writerow(row)
+        self.rows += 1
+
+
+    def writerows(self, rows):
+        """ Write rows as the iterable produces them, returns how many """
+
+        count = 0
+        for row in rows:
+            self.writer.writerow(row)
+            count += 1
+        self.rows += count
+
+        return count
+
+
+    def close(self):
+        """ Flush everything to disk, finishing the gzip stream """
+
+        if self.closed_bytes is not None:
+            return
+
+        self.text.flush()
+        self.text.detach()
+        if self.gzip:
+            self.gzip.close()
+        self.closed_bytes = self.raw.tell() - self.start
+        self.raw.close()
+        if self.path != self.file_name:
+            os.replace(self.path, self.file_name)
+
+
+    def abort(self):
+        """ Drop what was written, leaving file_name as it was """
+
+        if self.closed_bytes is not None:
+            return
+
+        self.closed_bytes = 0
+        try:
+            self.text.detach()
+            if self.gzip:
+                self.gzip.close()
+        except (OSError, ValueError):
+            pass
+
+        if self.path == self.file_name:
+            self.raw.truncate(self.start)
+            self.raw.close()
+        else:
+            self.raw.close()
+            os.remove(self.path)
+
+
+def write_csv(file_name, fieldnames, rows, compress=None, append=False):
+    """ Stream rows to a csv file, returns the closed CsvWriter with its counts
+
+    An exception from rows is raised once the partial file has been removed.
+    """
+
+    with CsvWriter(file_name, fieldnames, compress=compress, append=append) as writer:
+        writer.writerows(rows)
+
+    return writer
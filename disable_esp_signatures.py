@@ -37,6 +37,9 @@
 # * Python3 (Tested with version 3.6.1)
 #   `python --version`
 #
+# * aiohttp
+#   `pip install aiohttp`
+#
 # * Valid ESP credentials / API keys
 #   https://esp.evident.io/settings/api_keys
 #   export ESP_ACCESS_KEY_ID=<your_access_key>
@@ -46,23 +49,21 @@
 acct_exclude_list = [ '1111', '2222' ]
 
 
-from wsgiref.handlers import format_date_time
-from datetime import datetime
-from time import mktime
+from async_api_helper import AsyncApiHelper
+from response_cache import ResponseCache
 
-import hashlib
-import codecs
-import hmac
-import base64
-import requests
+import asyncio
 import json
-import os
+import sys
 import re
 import argparse
 
-# API keys from shell env
-pub_key = os.environ["ESP_ACCESS_KEY_ID"]
-secret_key = os.environ["ESP_SECRET_ACCESS_KEY"]
+# Number of API requests kept in flight at once
+concurrency = 20
+
+# Signature name lookups are cached between runs, the catalog rarely changes
+cache_file = 'esp_api_cache.sqlite'
+cache_ttls = { '/api/v2/signatures': 24 * 60 * 60 }
 
 
 def usage():
@@ -78,64 +79,13 @@ def script_args():
     return args
 
 
-def api_call(method, uri, data, timeout):
-    """ API call """
-
-    # ESP API endpoint - http://api-docs.evident.io/
-    url = 'https://api.evident.io'
-
-    # Uses the RFC-1123 spec. Note: Must be in the GMT timezone.
-    now   = datetime.now()
-    stamp = mktime(now.timetuple())
-    dated = format_date_time(stamp)
-
-    # The Content-MD5 header should include a MD5 base64 hexdigest of the request body.
-    hex  = hashlib.md5(data.encode('UTF-8')).hexdigest()
-    body = codecs.encode(codecs.decode(hex, 'hex'), 'base64').decode().rstrip('\n')
-
-    # Create a canonical string using your HTTP headers containing the HTTP method,
-    # content-type, content-MD5, request URI and the timestamp.
-    canonical = '%s,%s,%s,%s,%s' % (method, 'application/vnd.api+json', body, uri, dated)
-
-    # Convert from string to bytes.
-    secret = bytes(secret_key, 'UTF-8')
-    canonical = bytes(canonical, 'UTF-8')
-
-    # Use the HMAC-SHA1 algorithm to encode the string with your secret key.
-    hashed = hmac.new(secret, canonical, hashlib.sha1)
-    encoded = base64.b64encode(hashed.digest())
-    auth = str(encoded, 'UTF-8')
-
-    # Add an Authorization header with the ‘APIAuth’, the public key, and the encoded
-    # canonical string.
-
-    headers = { 'Date'          : '%s' % (dated),
-                'Content-MD5'   : '%s' % (body),
-                'Content-Type'  : 'application/vnd.api+json',
-                'Accept'        : 'application/vnd.api+json',
-                'Authorization' : 'APIAuth %s:%s' % (pub_key, auth) }
-
-    # Using requests
-    # http://docs.python-requests.org/en/latest/user/advanced/
-
-    r = requests.Request(method, url+uri, data=data, headers=headers)
-    p = r.prepare()
-    s = requests.Session()
-    ask = s.send(p, timeout=timeout)
-    response = ask.json()
-
-    return response
-
-
-def list_external_accounts():
+async def list_external_accounts(api):
     """ List external accounts """
 
-    method = 'GET'
     uri = '/api/v2/external_accounts'
-    data = ''
     timeout = (3, 10)
 
-    response = api_call(method, uri, data, timeout)
+    response = await api.get(uri, timeout)
 
     ext_acct_ids = []
     try:
@@ -150,19 +100,21 @@ def list_external_accounts():
     return ext_acct_ids
 
 
-def list_signatures(sig_names):
+async def list_signatures(api, sig_names):
     """ Convert Signature names to Ids """
 
-    method = 'GET'
-    data = ''
     timeout = (3, 10)
 
-    sig_ids = []
+    uris = []
     for sig_name in sig_names:
         sig_name = re.sub('\s', '+', sig_name)
-        uri = '/api/v2/signatures.json?filter[name_eq]=%s' % (sig_name)
-        response = api_call(method, uri, data, timeout)
+        uris.append('/api/v2/signatures.json?filter[name_eq]=%s' % (sig_name))
+
+    # Look up every name at once
+    responses = await asyncio.gather(*[ api.get(uri, timeout) for uri in uris ])
 
+    sig_ids = []
+    for response in responses:
         try:
             sig_id = response['data'][0]['id']
         except IndexError:
@@ -173,27 +125,43 @@ def list_signatures(sig_names):
     return sig_ids
 
 
-def disable_signatures(ext_acct_ids, sig_names):
-    """ Disable one or more signatures """
+async def disable_signature(api, acct, sig_id):
+    """ Disable one signature in one external account """
 
-    method = 'POST'
+    uri = '/api/v2/external_accounts/%s/disabled_signatures' % (acct)
+    data = '{"data": {"type": "disabled_signatures", "attributes": {"signature_id": %d}}}' % (sig_id)
     timeout = (3, 10)
 
-    sig_ids = list_signatures(sig_names)
+    response = await api.post(uri, data, timeout)
+    response['signature_id'] = sig_id
+    response['account_id'] = acct
+
+    return response
+
+
+async def disable_signatures(api, ext_acct_ids, sig_names):
+    """ Disable one or more signatures """
 
-    for acct in ext_acct_ids:
-        uri = '/api/v2/external_accounts/%s/disabled_signatures' % (acct)
+    sig_ids = await list_signatures(api, sig_names)
 
-        for sig_id in sig_ids:
-            data = '{"data": {"type": "disabled_signatures", "attributes": {"signature_id": %d}}}' % (sig_id)
-            response = api_call(method, uri, data, timeout)
-            response['signature_id'] = sig_id
-            response['account_id'] = acct
-            print(json.dumps(response, indent=4, sort_keys=True))
+    # One request per (account, signature) pair, bounded by the client's concurrency
+    jobs = [ disable_signature(api, acct, sig_id) for acct in ext_acct_ids for sig_id in sig_ids ]
+    for response in await asyncio.gather(*jobs):
+        print(json.dumps(response, indent=4, sort_keys=True))
 
     return
 
 
+async def run(sig_names):
+    """ Disable signatures in every external account """
+
+    cache = ResponseCache(cache_file, ttls=cache_ttls)
+    async with AsyncApiHelper(concurrency=concurrency, cache=cache) as api:
+        ext_acct_ids = await list_external_accounts(api)
+        await disable_signatures(api, ext_acct_ids, sig_names)
+    cache.close()
+
+
 def main():
     """ Do the work... """
 
@@ -201,8 +169,7 @@ def main():
     if args.s == '':
         usage()
 
-    ext_acct_ids = list_external_accounts()
-    disable_signatures(ext_acct_ids, args.s)
+    asyncio.run(run(args.s))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,937 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, 2014, 2015, 2016, 2017. Evident.io (Evident). All Rights Reserved. 
+# 
+#   Evident.io shall retain all ownership of all right, title and interest in and to 
+#   the Licensed Software, Documentation, Source Code, Object Code, and API's ("Deliverables"), 
+#   including (a) all information and technology capable of general application to Evident.io's
+#   customers; and (b) any works created by Evident.io prior to its commencement of any
+#   Services for Customer.
+# 
+# Upon receipt of all fees, expenses and taxes due in respect of the relevant Services, 
+#   Evident.io grants the Customer a perpetual, royalty-free, non-transferable, license to 
+#   use, copy, configure and translate any Deliverable solely for internal business operations
+#   of the Customer as they relate to the Evident.io platform and products, and always
+#   subject to Evident.io's underlying intellectual property rights.
+# 
+# IN NO EVENT SHALL EVIDENT.IO BE LIABLE TO ANY PARTY FOR DIRECT, INDIRECT, SPECIAL, 
+#   INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING LOST PROFITS, ARISING OUT OF 
+#   THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION, EVEN IF EVIDENT.IO HAS BEEN HAS BEEN
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# EVIDENT.IO SPECIFICALLY DISCLAIMS ANY WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE. 
+#   THE SOFTWARE AND ACCOMPANYING DOCUMENTATION, IF ANY, PROVIDED HEREUNDER IS PROVIDED "AS IS". 
+#   EVIDENT.IO HAS NO OBLIGATION TO PROVIDE MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS,
+#   OR MODIFICATIONS.
+# 
+# ---
+#
+# Local ESP API stand-in
+#
+# Serves a synthetic organization over the JSON:API endpoints used by the scripts in
+# this repository, so they can be run and benchmarked without api.evident.io:
+#
+#   signatures, roles, users, teams, organizations, regions, external_accounts,
+#   external_accounts/{id}/disabled_signatures, signature_custom_risk_levels,
+#   suppressions, audit_logs, reports, reports/{id}/alerts and stats/latest_for_teams
+#
+# Requests must carry a valid APIAuth signature for ESP_ACCESS_KEY_ID and
+# ESP_SECRET_ACCESS_KEY, over the path as sent or its percent-decoded form. Lists support
+# page[number] / page[size] with links, filter[...] predicates (_eq, _cont, _in, _gt, _gte,
+# _lt, _lte, also across relationships such as filter[signature_identifier_cont]) and
+# include= sideloading. GET responses carry an ETag and honor If-None-Match.
+#
+# --scale sets the size of the organization: 1 is our size (10 teams, 50 external accounts,
+# 100 users, 200 suppressions, 2000 audit logs over 30 days, one latest report per
+# account), 10, 100 and 1000 multiply every per-org count. Documents are generated on
+# demand, so even --scale 1000 starts instantly. New audit logs keep arriving at the
+# same rate while the server runs.
+#
+# --latency (plus random --jitter) delays every response, --rate-limit answers 429 with
+# Retry-After once more than that many requests per second arrive.
+#
+# Usage:
+#
+#   export ESP_ACCESS_KEY_ID=<any_access_key>
+#   export ESP_SECRET_ACCESS_KEY=<any_secret_access_key>
+#   python esp_mock_server.py --port 8080 --scale 100 --latency 0.05 --rate-limit 20
+#
+#   export ESP_API_URL=http://127.0.0.1:8080
+#   python suppression_audit_v3.py
+#
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, parse_qs, quote, unquote
+from request_signer import RequestSigner
+from datetime import datetime, timezone
+
+import threading
+import argparse
+import hashlib
+import random
+import math
+import json
+import time
+import re
+import os
+
+# Fixed catalogs, the same at every scale
+SERVICES = [ 'CONFIG', 'VPC', 'EC2', 'IAM', 'S3', 'RDS', 'ELB', 'SQS', 'SNS', 'CLOUDTRAIL' ]
+REGIONS = [ 'us_east_1', 'us_east_2', 'us_west_1', 'us_west_2', 'ca_central_1', 'eu_west_1', 'eu_west_2',
+            'eu_central_1', 'ap_south_1', 'ap_northeast_1', 'ap_northeast_2', 'ap_southeast_1',
+            'ap_southeast_2', 'sa_east_1', 'global', 'us_gov_west_1' ]
+ROLES = [ 'evident_admin', 'manager', 'customer', 'auditor', 'read_only' ]
+RISK_LEVELS = [ 'High', 'Medium', 'Low' ]
+ACTIONS = [ 'create', 'update', 'destroy', 'login', 'logout', 'export' ]
+ITEM_TYPES = [ 'User', 'ExternalAccount', 'Suppression', 'Team', 'Signature', 'Report' ]
+
+NUM_SIGNATURES = 1000
+REPORT_ID_OFFSET = 1000000
+WEEK = 7 * 24 * 60 * 60
+
+
+def iso(stamp, millis=False):
+    """ ESP style timestamp, e.g. 2017-05-01T10:00:00.000Z """
+
+    moment = datetime.fromtimestamp(stamp, timezone.utc)
+    ms = int(moment.microsecond / 1000) if millis else 0
+
+    return moment.strftime('%Y-%m-%dT%H:%M:%S') + '.%03dZ' % (ms)
+
+
+def epoch(value):
+    """ Seconds since the epoch from an ISO-8601 timestamp or a number """
+
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    value = value.strip().replace('Z', '+00:00')
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+
+    return moment.timestamp()
+
+
+class SyntheticOrg():
+
+    def __init__(self, scale=1, alerts_per_report=300, millis=False, anchor=None):
+        """ A deterministic organization, `scale` times our size """
+
+        self.scale = scale
+        self.alerts_per_report = alerts_per_report
+        self.millis = millis
+
+        # Every generated timestamp is relative to the anchor, so documents stay the same
+        # for the life of the server.
+        self.anchor = int(anchor or time.time())
+
+        self.counts = { 'signatures'        : NUM_SIGNATURES,
+                        'regions'           : len(REGIONS),
+                        'roles'             : len(ROLES),
+                        'organizations'     : 1,
+                        'teams'             : 10 * scale,
+                        'external_accounts' : 50 * scale,
+                        'users'             : 100 * scale,
+                        'suppressions'      : 200 * scale }
+
+        # Audit logs are spread over the last 30 days and keep arriving at that rate.
+        self.audit_logs_base = 2000 * scale
+        self.audit_log_step = 30 * 24 * 60 * 60 / float(self.audit_logs_base)
+
+        # Changes made through the API: attribute overrides by (type, id) and created
+        # documents by type.
+        self.lock = threading.Lock()
+        self.overrides = {}
+        self.created = {}
+        self.next_id = 100000001
+
+
+    def ts(self, seconds_ago):
+        """ Timestamp `seconds_ago` before the anchor """
+
+        return iso(self.anchor - seconds_ago, self.millis)
+
+
+    def count(self, doc_type):
+        """ Number of documents of a type """
+
+        if doc_type == 'audit_logs':
+            return self.audit_logs_base + max(0, int((time.time() - self.anchor) / self.audit_log_step))
+        if doc_type == 'reports' or doc_type == 'stats':
+            return self.counts['external_accounts']
+
+        return self.counts.get(doc_type, 0)
+
+
+    def ids(self, doc_type):
+        """ Ids of a type in default sort order """
+
+        n = self.count(doc_type)
+        if doc_type == 'audit_logs':
+            ids = range(n, 0, -1)
+        elif doc_type == 'reports' or doc_type == 'stats':
+            ids = range(REPORT_ID_OFFSET + 1, REPORT_ID_OFFSET + n + 1)
+        else:
+            ids = range(1, n + 1)
+
+        # Documents created through the API come after the generated ones.
+        if self.created.get(doc_type):
+            return list(ids) + sorted(self.created[doc_type])
+
+        return ids
+
+
+    def get(self, doc_type, doc_id):
+        """ Document by type and id, None if there is no such document """
+
+        try:
+            doc_id = int(doc_id)
+        except (TypeError, ValueError):
+            return None
+
+        if doc_id in self.created.get(doc_type, {}):
+            doc = self.created[doc_type][doc_id]
+            return dict(doc, attributes=dict(doc['attributes']))
+
+        if doc_type == 'alerts':
+            report_id, i = divmod(doc_id, self.alerts_per_report)
+            if self.get('reports', report_id) is None:
+                return None
+            return self.alert(report_id, i)
+
+        if doc_type in ('reports', 'stats'):
+            if not REPORT_ID_OFFSET < doc_id <= REPORT_ID_OFFSET + self.count(doc_type):
+                return None
+        elif not 0 < doc_id <= self.count(doc_type) or not hasattr(self, doc_type):
+            return None
+
+        doc = getattr(self, doc_type)(doc_id)
+        doc['type'] = doc_type
+        doc['id'] = str(doc_id)
+        doc['attributes'].update(self.overrides.get((doc_type, doc_id), {}))
+
+        return doc
+
+
+    # Generators, one per type. Relationships map a name to (type, id), (type, [ids])
+    # or (type, None) for a has-many relationship served under the document's own path.
+
+    def signatures(self, n):
+        service = SERVICES[n % len(SERVICES)]
+        return { 'attributes'    : { 'name'        : '%s check %04d' % (service.title(), n),
+                                     'identifier'  : 'AWS:%s-%03d' % (service, n),
+                                     'description' : 'Synthetic signature %d' % (n),
+                                     'risk_level'  : RISK_LEVELS[n % 3],
+                                     'created_at'  : self.ts(400 * 86400),
+                                     'updated_at'  : self.ts(300 * 86400) },
+                 'relationships' : {} }
+
+
+    def regions(self, n):
+        return { 'attributes'    : { 'code': REGIONS[n - 1], 'name': REGIONS[n - 1].replace('_', '-') },
+                 'relationships' : {} }
+
+
+    def roles(self, n):
+        return { 'attributes'    : { 'name': ROLES[n - 1] },
+                 'relationships' : {} }
+
+
+    def organizations(self, n):
+        return { 'attributes'    : { 'name': 'Synthetic Org x%d' % (self.scale), 'created_at': self.ts(500 * 86400) },
+                 'relationships' : {} }
+
+
+    def teams(self, n):
+        return { 'attributes'    : { 'name'       : 'Team %d' % (n),
+                                     'created_at' : self.ts(200 * 86400),
+                                     'updated_at' : self.ts(100 * 86400) },
+                 'relationships' : { 'organization' : ('organizations', 1) } }
+
+
+    def external_accounts(self, n):
+        team = (n - 1) % self.counts['teams'] + 1
+        return { 'attributes'    : { 'name'       : 'Account %d' % (n),
+                                     'account'    : '%012d' % (100000000000 + n),
+                                     'arn'        : 'arn:aws:iam::%012d:role/Evident-Service-Role' % (100000000000 + n),
+                                     'created_at' : self.ts(150 * 86400),
+                                     'updated_at' : self.ts((n % 60) * 86400) },
+                 'relationships' : { 'team'                : ('teams', team),
+                                     'organization'        : ('organizations', 1),
+                                     'disabled_signatures' : ('disabled_signatures', None) } }
+
+
+    def users(self, n):
+        return { 'attributes'    : { 'first_name'  : 'First%d' % (n),
+                                     'last_name'   : 'Last%d' % (n),
+                                     'email'       : 'user%d@example.com' % (n),
+                                     'mfa_enabled' : n % 3 != 0,
+                                     'created_at'  : self.ts(n % 365 * 86400),
+                                     'updated_at'  : self.ts(n % 30 * 86400) },
+                 'relationships' : { 'role'         : ('roles', n % len(ROLES) + 1),
+                                     'organization' : ('organizations', 1),
+                                     'teams'        : ('teams', [ (n - 1) % self.counts['teams'] + 1 ]) } }
+
+
+    def suppressions(self, n):
+        accounts = self.counts['external_accounts']
+        ext_accounts = [ (n * k) % accounts + 1 for k in range(1, n % 3 + 2) ]
+        regions = [ (n + k) % len(REGIONS) + 1 for k in range(n % 2 + 1) ]
+        signatures = [] if n % 5 == 0 else [ n % NUM_SIGNATURES + 1 ]
+        return { 'attributes'    : { 'suppression_type' : [ 'signatures', 'regions', 'resource' ][n % 3],
+                                     'status'           : 'inactive' if n % 9 == 0 else 'active',
+                                     'reason'           : 'Synthetic reason %d' % (n),
+                                     'resource'         : 'arn:aws:s3:::bucket-%d' % (n) if n % 3 == 2 else None,
+                                     'created_at'       : self.ts(n % 400 * 86400 + n),
+                                     'updated_at'       : self.ts(n % 40 * 86400 + n) },
+                 'relationships' : { 'created_by'        : ('users', n % self.counts['users'] + 1),
+                                     'regions'           : ('regions', regions),
+                                     'external_accounts' : ('external_accounts', sorted(set(ext_accounts))),
+                                     'signatures'        : ('signatures', signatures) } }
+
+
+    def audit_logs(self, n):
+        users = self.counts['users']
+        created = self.anchor + (n - self.audit_logs_base) * self.audit_log_step
+        user = n % users + 1
+        return { 'attributes'    : { 'platform'      : 'web' if n % 4 else 'api',
+                                     'created_at'    : iso(created, self.millis),
+                                     'user_email'    : 'user%d@example.com' % (user),
+                                     'user_ip'       : '10.0.%d.%d' % (n % 250, n % 200 + 1),
+                                     'access_denied' : n % 50 == 0,
+                                     'successful'    : n % 40 != 0,
+                                     'action'        : ACTIONS[n % len(ACTIONS)],
+                                     'item_type'     : ITEM_TYPES[n % len(ITEM_TYPES)],
+                                     'item_id'       : n % 997 + 1 },
+                 'relationships' : { 'organization' : ('organizations', 1),
+                                     'user'         : ('users', user) } }
+
+
+    def reports(self, n):
+        account = n - REPORT_ID_OFFSET
+        team = (account - 1) % self.counts['teams'] + 1
+        return { 'attributes'    : { 'status'     : 'complete',
+                                     'created_at' : self.ts(account % 3600),
+                                     'updated_at' : self.ts(account % 3600) },
+                 'relationships' : { 'team'             : ('teams', team),
+                                     'external_account' : ('external_accounts', account),
+                                     'organization'     : ('organizations', 1),
+                                     'alerts'           : ('alerts', None) } }
+
+
+    def alert(self, report_id, i):
+        """ Alert i of a report """
+
+        account = report_id - REPORT_ID_OFFSET
+        seed = i * 7919 + account * 104729
+        sig = seed % NUM_SIGNATURES + 1
+        doc = { 'type'          : 'alerts',
+                'id'            : str(report_id * self.alerts_per_report + i),
+                'attributes'    : { 'status'     : [ 'fail', 'fail', 'warn', 'pass' ][seed % 4],
+                                    'risk_level' : RISK_LEVELS[sig % 3],
+                                    'resource'   : 'resource-%d-%d' % (account, i),
+                                    'created_at' : self.ts(seed % (30 * 86400)),
+                                    'updated_at' : self.ts(seed % 3600) },
+                'relationships' : { 'signature'        : ('signatures', sig),
+                                    'external_account' : ('external_accounts', account),
+                                    'region'           : ('regions', seed % len(REGIONS) + 1),
+                                    'report'           : ('reports', report_id) } }
+
+        return doc
+
+
+    def alerts(self, report_id):
+        """ Every alert of a report """
+
+        return [ self.alert(report_id, i) for i in range(self.alerts_per_report) ]
+
+
+    def stats(self, n):
+        counts = {}
+        for level in RISK_LEVELS:
+            for status in ('fail', 'warn', 'pass'):
+                counts['%s_%s' % (level.lower(), status)] = 0
+                counts['new_1w_%s_%s' % (level.lower(), status)] = 0
+
+        week_ago = iso(self.anchor - WEEK)
+        for alert in self.alerts(n):
+            key = '%s_%s' % (alert['attributes']['risk_level'].lower(), alert['attributes']['status'])
+            counts[key] += 1
+            if alert['attributes']['created_at'] >= week_ago:
+                counts['new_1w_' + key] += 1
+
+        return { 'attributes'    : counts,
+                 'relationships' : { 'report' : ('reports', n) } }
+
+
+    def create(self, doc_type, attributes, relationships=None):
+        """ Store a document created through the API """
+
+        with self.lock:
+            doc_id = self.next_id
+            self.next_id += 1
+            now = iso(time.time(), self.millis)
+            doc = { 'type'          : doc_type,
+                    'id'            : str(doc_id),
+                    'attributes'    : dict(attributes, created_at=now, updated_at=now),
+                    'relationships' : relationships or {} }
+            self.created.setdefault(doc_type, {})[doc_id] = doc
+
+        return self.get(doc_type, doc_id)
+
+
+    def update(self, doc_type, doc_id, attributes):
+        """ Change attributes of a document, returns the updated document """
+
+        if self.get(doc_type, doc_id) is None:
+            return None
+
+        attributes = dict(attributes, updated_at=iso(time.time(), self.millis))
+        with self.lock:
+            if int(doc_id) in self.created.get(doc_type, {}):
+                self.created[doc_type][int(doc_id)]['attributes'].update(attributes)
+            else:
+                self.overrides.setdefault((doc_type, int(doc_id)), {}).update(attributes)
+
+        return self.get(doc_type, doc_id)
+
+
+class MockApi():
+
+    # Filter predicates, filter[<field>_<predicate>]
+    predicate = re.compile(r'^(.+)_(eq|cont|in|gt|gte|lt|lte)$')
+
+    def __init__(self, org, pub_key, secret_key, page_size=20, max_page_size=100):
+        """ Routes, pagination, filtering and sideloading over a SyntheticOrg """
+
+        self.org = org
+        self.pub_key = pub_key
+        self.signer = RequestSigner(pub_key, secret_key)
+        self.page_size = page_size
+        self.max_page_size = max_page_size
+
+        self.routes = [ ('GET',    r'/api/v2/stats/latest_for_teams',                                 self.latest_for_teams),
+                        ('GET',    r'/api/v2/reports/(?P<report_id>\d+)/alerts',                      self.list_alerts),
+                        ('GET',    r'/api/v2/external_accounts/(?P<acct>\d+)/disabled_signatures',    self.list_disabled),
+                        ('POST',   r'/api/v2/external_accounts/(?P<acct>\d+)/disabled_signatures',    self.disable_signature),
+                        ('GET',    r'/api/v2/external_accounts/(?P<acct>\d+)/signature_custom_risk_levels', self.list_risk_levels),
+                        ('PATCH',  r'/api/v2/suppressions/(?P<doc_id>\d+)/deactivate',                self.deactivate),
+                        ('GET',    r'/api/v2/(?P<doc_type>\w+)',                                      self.list_documents),
+                        ('POST',   r'/api/v2/(?P<doc_type>\w+)',                                      self.create_document),
+                        ('GET',    r'/api/v2/(?P<doc_type>\w+)/(?P<doc_id>\d+)',                      self.show_document),
+                        ('PATCH',  r'/api/v2/(?P<doc_type>\w+)/(?P<doc_id>\d+)',                      self.update_document) ]
+        self.routes = [ (method, re.compile('^%s(?:\\.json)?$' % (path)), handler) for method, path, handler in self.routes ]
+
+
+    # --- Authentication ---
+
+    def authorized(self, method, path, headers, body):
+        """ Check the APIAuth signature of a request """
+
+        auth = headers.get('Authorization') or ''
+        match = re.match(r'^APIAuth ([^:]+):(.+)$', auth)
+        if not match or match.group(1) != self.pub_key:
+            return False
+
+        content_md5 = headers.get('Content-MD5') or ''
+        if content_md5 != self.signer.content_md5(body.decode('UTF-8')):
+            return False
+
+        dated = headers.get('Date') or ''
+        try:
+            if abs(time.time() - datetime.strptime(dated, '%a, %d %b %Y %H:%M:%S GMT').replace(tzinfo=timezone.utc).timestamp()) > 15 * 60:
+                return False
+        except ValueError:
+            return False
+
+        # Clients sign the uri before their HTTP library percent-encodes it, or the path
+        # as sent; either form is accepted.
+        for signed_path in (path, unquote(path)):
+            if self.signer.sign(method, signed_path, dated=dated, body=content_md5)['Authorization'] == auth:
+                return True
+
+        return False
+
+
+    # --- Request handling ---
+
+    def handle(self, method, target, headers, body, base_url):
+        """ Returns (status, document) for a request """
+
+        if not self.authorized(method, target, headers, body):
+            return 401, errors(401, 'Unauthorized')
+
+        parts = urlsplit(target)
+        query = parse_qs(parts.query)
+        for route_method, pattern, handler in self.routes:
+            match = pattern.match(parts.path)
+            if match and route_method == method:
+                try:
+                    payload = json.loads(body.decode('UTF-8')) if body else {}
+                except ValueError:
+                    return 400, errors(400, 'Bad Request')
+                return handler(query=query, payload=payload, base_url=base_url, target=target, **match.groupdict())
+
+        return 404, errors(404, 'Not Found')
+
+
+    def page(self, docs, total, query, base_url, target):
+        """ Slice a list into the requested page and add pagination links """
+
+        number = max(1, int(first(query, 'page[number]') or 1))
+        size = min(self.max_page_size, max(1, int(first(query, 'page[size]') or self.page_size)))
+        last = max(1, int(math.ceil(total / float(size))))
+
+        start = (number - 1) * size
+        if callable(docs):
+            data = docs(start, start + size)
+        else:
+            data = docs[start:start + size]
+
+        def link(n):
+            path, _, qs = target.partition('?')
+            params = [ p for p in qs.split('&') if p and not p.startswith(('page[', 'page%5B', 'page%5b')) ]
+            params += [ 'page%5Bnumber%5D=' + str(n), 'page%5Bsize%5D=' + str(size) ]
+            return base_url + path + '?' + '&'.join(params)
+
+        links = { 'self': link(number), 'first': link(1), 'last': link(last) }
+        if number > 1:
+            links['prev'] = link(number - 1)
+        if number < last:
+            links['next'] = link(number + 1)
+
+        return data, links
+
+
+    def render(self, doc, base_url, includes=()):
+        """ JSON:API form of a generated document """
+
+        relationships = {}
+        for name, (rel_type, rel_id) in doc['relationships'].items():
+            if rel_id is None:
+                related = '%s/api/v2/%s/%s/%s.json' % (base_url, doc['type'], doc['id'], name)
+                relationships[name] = { 'links': { 'related': related } }
+                continue
+
+            if isinstance(rel_id, list):
+                related = '%s/api/v2/%s.json?filter%%5Bid_in%%5D=%s' % (base_url, rel_type, quote(','.join(str(i) for i in rel_id)))
+            else:
+                related = '%s/api/v2/%s/%s.json' % (base_url, rel_type, rel_id)
+            relationships[name] = { 'links': { 'related': related } }
+
+            # Resource linkage is only sent for sideloaded relationships.
+            if name in includes:
+                if isinstance(rel_id, list):
+                    relationships[name]['data'] = [ { 'type': rel_type, 'id': str(i) } for i in rel_id ]
+                else:
+                    relationships[name]['data'] = { 'type': rel_type, 'id': str(rel_id) }
+
+        return { 'id': doc['id'], 'type': doc['type'], 'attributes': doc['attributes'], 'relationships': relationships }
+
+
+    def included(self, docs, includes, base_url):
+        """ Unique related documents for the requested include names """
+
+        seen = set()
+        out = []
+        for doc in docs:
+            for name in includes:
+                if name not in doc['relationships']:
+                    continue
+                rel_type, rel_ids = doc['relationships'][name]
+                if rel_ids is None:
+                    continue
+                for rel_id in rel_ids if isinstance(rel_ids, list) else [ rel_ids ]:
+                    if (rel_type, rel_id) in seen:
+                        continue
+                    seen.add((rel_type, rel_id))
+                    related = self.org.get(rel_type, rel_id)
+                    if related is not None:
+                        out.append(self.render(related, base_url))
+
+        return out
+
+
+    def field(self, doc, name):
+        """ Value of a filter field, following relationships, e.g. signature_identifier """
+
+        if name == 'id':
+            return doc['id']
+        if name in doc['attributes']:
+            return doc['attributes'][name]
+
+        for rel_name, (rel_type, rel_id) in doc['relationships'].items():
+            if name.startswith(rel_name + '_') and rel_id is not None and not isinstance(rel_id, list):
+                related = self.org.get(rel_type, rel_id)
+                if related is not None:
+                    return self.field(related, name[len(rel_name) + 1:])
+
+        return None
+
+
+    def matcher(self, query):
+        """ Predicate for the filter[...] parameters of a request, None without filters """
+
+        tests = []
+        for key, values in query.items():
+            if not (key.startswith('filter[') and key.endswith(']')):
+                continue
+            match = self.predicate.match(key[7:-1])
+            if not match:
+                continue
+            name, pred = match.groups()
+            value = values[0] if len(values) == 1 else ','.join(values)
+            tests.append((name, pred, value))
+
+        if not tests:
+            return None
+
+        def compare(actual, pred, value, name):
+            if actual is None:
+                return False
+            if pred == 'eq':
+                return str(actual).lower() == value.lower()
+            if pred == 'cont':
+                return value.lower() in str(actual).lower()
+            if pred == 'in':
+                return str(actual) in value.split(',')
+            try:
+                if name.endswith('_at'):
+                    actual, value = epoch(actual), epoch(value)
+                else:
+                    actual, value = float(actual), float(value)
+            except ValueError:
+                return False
+            return { 'gt': actual > value, 'gte': actual >= value, 'lt': actual < value, 'lte': actual <= value }[pred]
+
+        return lambda doc: all(compare(self.field(doc, name), pred, value, name) for name, pred, value in tests)
+
+
+    def listing(self, doc_type, docs_or_ids, query, base_url, target, includes=()):
+        """ Filtered, paginated list response """
+
+        matches = self.matcher(query)
+        filters = [ k for k in query if k.startswith('filter[') ]
+
+        if filters == [ 'filter[id_in]' ] and not isinstance(docs_or_ids, list):
+            # Direct lookup rather than a scan
+            ids = [ i for i in ','.join(query['filter[id_in]']).split(',') if i ]
+            docs = [ d for d in (self.org.get(doc_type, i) for i in ids) if d is not None ]
+            data, links = self.page(docs, len(docs), query, base_url, target)
+        elif matches is None and not isinstance(docs_or_ids, list):
+            ids = docs_or_ids
+            data, links = self.page(lambda a, b: [ self.org.get(doc_type, i) for i in ids[a:b] ], len(ids), query, base_url, target)
+        else:
+            docs = docs_or_ids if isinstance(docs_or_ids, list) else (self.org.get(doc_type, i) for i in docs_or_ids)
+            docs = [ d for d in docs if matches is None or matches(d) ]
+            data, links = self.page(docs, len(docs), query, base_url, target)
+
+        document = { 'data': [ self.render(d, base_url, includes) for d in data ], 'links': links }
+        if includes:
+            document['included'] = self.included(data, includes, base_url)
+
+        return 200, document
+
+
+    # --- Endpoints ---
+
+    def list_documents(self, doc_type, query, base_url, target, **kwargs):
+        if doc_type not in self.org.counts and doc_type not in ('audit_logs', 'reports', 'disabled_signatures', 'signature_custom_risk_levels'):
+            return 404, errors(404, 'Not Found')
+
+        includes = includes_of(query)
+
+        # Audit logs are newest first, a created_at window is a prefix of the list.
+        window = first(query, 'filter[created_at_gte]') or first(query, 'filter[created_at_gt]')
+        if doc_type == 'audit_logs' and window and len([ k for k in query if k.startswith('filter[') ]) == 1:
+            since = epoch(window)
+            ids = self.org.ids('audit_logs')
+            newest = ids[0] if len(ids) else 0
+            oldest = int(math.ceil((since - self.org.anchor) / self.org.audit_log_step + self.org.audit_logs_base))
+            ids = range(newest, max(oldest, 1) - 1, -1)
+            query = dict((k, v) for k, v in query.items() if not k.startswith('filter['))
+            return self.listing(doc_type, ids, query, base_url, target, includes)
+
+        return self.listing(doc_type, self.org.ids(doc_type), query, base_url, target, includes)
+
+
+    def show_document(self, doc_type, doc_id, query, base_url, **kwargs):
+        doc = self.org.get(doc_type, doc_id)
+        if doc is None:
+            return 404, errors(404, 'Not Found')
+
+        includes = includes_of(query)
+        document = { 'data': self.render(doc, base_url, includes) }
+        if includes:
+            document['included'] = self.included([ doc ], includes, base_url)
+
+        return 200, document
+
+
+    def create_document(self, payload, base_url, target, doc_type=None, **kwargs):
+        doc_type = doc_type or urlsplit(target).path.split('/')[3].split('.')[0]
+        try:
+            attributes = payload['data']['attributes']
+        except (KeyError, TypeError):
+            return 422, errors(422, 'Unprocessable Entity')
+
+        relationships = {}
+        for key in list(attributes):
+            if key.endswith('_id') and key[:-3] + 's' in self.org.counts:
+                relationships[key[:-3]] = (key[:-3] + 's', int(attributes[key]))
+
+        doc = self.org.create(doc_type, attributes, relationships)
+
+        return 201, { 'data': self.render(doc, base_url) }
+
+
+    def update_document(self, doc_type, doc_id, payload, base_url, **kwargs):
+        try:
+            attributes = payload['data']['attributes']
+        except (KeyError, TypeError):
+            return 422, errors(422, 'Unprocessable Entity')
+
+        doc = self.org.update(doc_type, doc_id, attributes)
+        if doc is None:
+            return 404, errors(404, 'Not Found')
+
+        return 200, { 'data': self.render(doc, base_url) }
+
+
+    def deactivate(self, doc_id, base_url, **kwargs):
+        doc = self.org.update('suppressions', doc_id, { 'status': 'inactive' })
+        if doc is None:
+            return 404, errors(404, 'Not Found')
+
+        return 200, { 'data': self.render(doc, base_url) }
+
+
+    def list_alerts(self, report_id, query, base_url, target, **kwargs):
+        if self.org.get('reports', report_id) is None:
+            return 404, errors(404, 'Not Found')
+
+        return self.listing('alerts', self.org.alerts(int(report_id)), query, base_url, target, includes_of(query))
+
+
+    def latest_for_teams(self, query, base_url, target, **kwargs):
+        return self.listing('stats', self.org.ids('stats'), query, base_url, target, includes_of(query))
+
+
+    def list_disabled(self, acct, query, base_url, target, **kwargs):
+        docs = [ d for d in self.org.created.get('disabled_signatures', {}).values() if d['attributes'].get('external_account_id') == int(acct) ]
+        return self.listing('disabled_signatures', docs, query, base_url, target)
+
+
+    def disable_signature(self, acct, payload, base_url, **kwargs):
+        if self.org.get('external_accounts', acct) is None:
+            return 404, errors(404, 'Not Found')
+        try:
+            sig_id = int(payload['data']['attributes']['signature_id'])
+        except (KeyError, TypeError, ValueError):
+            return 422, errors(422, 'Unprocessable Entity')
+
+        doc = self.org.create('disabled_signatures', { 'external_account_id': int(acct), 'signature_id': sig_id },
+                              { 'external_account': ('external_accounts', int(acct)), 'signature': ('signatures', sig_id) })
+
+        return 201, { 'data': self.render(doc, base_url) }
+
+
+    def list_risk_levels(self, acct, query, base_url, target, **kwargs):
+        docs = [ d for d in self.org.created.get('signature_custom_risk_levels', {}).values() if int(d['attributes'].get('external_account_id', 0)) == int(acct) ]
+        return self.listing('signature_custom_risk_levels', docs, query, base_url, target)
+
+
+def errors(status, title):
+    """ JSON:API error document """
+
+    return { 'errors': [ { 'status': str(status), 'title': title } ] }
+
+
+def first(query, key):
+    """ First value of a query parameter """
+
+    values = query.get(key)
+    return values[0] if values else None
+
+
+def includes_of(query):
+    """ Relationship names from include= """
+
+    return tuple(name for name in (first(query, 'include') or '').split(',') if name)
+
+
+class TokenBucket():
+
+    def __init__(self, rate, burst):
+        """ Server side request quota """
+
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+
+    def take(self):
+        """ 0 if the request may proceed, otherwise the seconds until it may """
+
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+
+            return (1 - self.tokens) / self.rate
+
+
+class MockServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+    verbose = False
+
+    def __init__(self, address, api, latency=0.0, jitter=0.0, rate_limit=0, burst=None):
+        """ Threaded HTTP server in front of a MockApi """
+
+        HTTPServer.__init__(self, address, MockHandler)
+        self.api = api
+        self.latency = latency
+        self.jitter = jitter
+        self.bucket = TokenBucket(rate_limit, burst) if rate_limit else None
+        self.requests = 0
+        self.throttled = 0
+        self.counter_lock = threading.Lock()
+
+
+    @property
+    def url(self):
+        """ Base url to use as ESP_API_URL """
+
+        return 'http://%s:%d' % self.server_address[:2]
+
+
+class MockHandler(BaseHTTPRequestHandler):
+
+    # Keep-alive, every response has a Content-Length
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.respond('GET')
+
+    def do_POST(self):
+        self.respond('POST')
+
+    def do_PATCH(self):
+        self.respond('PATCH')
+
+    def do_DELETE(self):
+        self.respond('DELETE')
+
+
+    def respond(self, method):
+        """ Delay, throttle, then answer the request """
+
+        server = self.server
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+
+        with server.counter_lock:
+            server.requests += 1
+
+        if server.latency or server.jitter:
+            time.sleep(server.latency + random.uniform(0, server.jitter))
+
+        headers = { 'Content-Type': 'application/vnd.api+json' }
+        wait = server.bucket.take() if server.bucket else 0
+        if wait:
+            with server.counter_lock:
+                server.throttled += 1
+            status, document = 429, errors(429, 'Too Many Requests')
+            headers['Retry-After'] = str(int(math.ceil(wait)))
+        else:
+            base_url = 'http://%s' % (self.headers.get('Host') or '%s:%d' % server.server_address[:2])
+            try:
+                status, document = server.api.handle(method, self.path, self.headers, body, base_url)
+            except Exception as e:
+                status, document = 500, errors(500, 'Internal Server Error: %s' % (e))
+
+        payload = json.dumps(document).encode('UTF-8')
+        if method == 'GET' and status == 200:
+            etag = '"%s"' % (hashlib.md5(payload).hexdigest())
+            headers['ETag'] = etag
+            if self.headers.get('If-None-Match') == etag:
+                status, payload = 304, b''
+
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+def start(scale=1, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, rate_limit=0, burst=None,
+          alerts_per_report=300, millis=False, verbose=False):
+    """ Run a mock server in a background thread, returns the server """
+
+    # Use from a benchmark: server = start(scale=100); os.environ['ESP_API_URL'] = server.url
+    org = SyntheticOrg(scale, alerts_per_report=alerts_per_report, millis=millis)
+    api = MockApi(org, os.environ["ESP_ACCESS_KEY_ID"], os.environ["ESP_SECRET_ACCESS_KEY"])
+    server = MockServer((host, port), api, latency=latency, jitter=jitter, rate_limit=rate_limit, burst=burst)
+    server.verbose = verbose
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    return server
+
+
+def script_args():
+    p = argparse.ArgumentParser(description='Local ESP API stand-in.')
+    p.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    p.add_argument('--port', type=int, default=8080, help='port to listen on')
+    p.add_argument('--scale', type=int, default=1, help='organization size, e.g. 1, 10, 100 or 1000 times ours')
+    p.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    p.add_argument('--jitter', type=float, default=0.0, help='up to this many random seconds added on top of --latency')
+    p.add_argument('--rate-limit', type=float, default=0, help='requests per second before answering 429, 0 for no limit')
+    p.add_argument('--burst', type=float, default=None, help='requests allowed back to back, defaults to --rate-limit')
+    p.add_argument('--alerts-per-report', type=int, default=300, help='alerts in every report')
+    p.add_argument('--millis', action='store_true', help='non-zero milliseconds in generated timestamps')
+    p.add_argument('--verbose', action='store_true', help='log every request')
+    args = p.parse_args()
+
+    return args
+
+
+def main():
+    """ Serve until interrupted """
+
+    args = script_args()
+    server = start(args.scale, args.host, args.port, args.latency, args.jitter, args.rate_limit, args.burst,
+                   args.alerts_per_report, args.millis, args.verbose)
+
+    print('ESP mock API at %s (scale x%d), export ESP_API_URL=%s' % (server.url, args.scale, server.url))
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        pass
+
+    print('Served %d requests, %d throttled.' % (server.requests, server.throttled))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+
+    main()
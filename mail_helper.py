@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, 2014, 2015, 2016, 2017. Evident.io (Evident). All Rights Reserved. 
+# 
+#   Evident.io shall retain all ownership of all right, title and interest in and to 
+#   the Licensed Software, Documentation, Source Code, Object Code, and API's ("Deliverables"), 
+#   including (a) all information and technology capable of general application to Evident.io's
+#   customers; and (b) any works created by Evident.io prior to its commencement of any
+#   Services for Customer.
+# 
+# Upon receipt of all fees, expenses and taxes due in respect of the relevant Services, 
+#   Evident.io grants the Customer a perpetual, royalty-free, non-transferable, license to 
+#   use, copy, configure and translate any Deliverable solely for internal business operations
+#   of the Customer as they relate to the Evident.io platform and products, and always
+#   subject to Evident.io's underlying intellectual property rights.
+# 
+# IN NO EVENT SHALL EVIDENT.IO BE LIABLE TO ANY PARTY FOR DIRECT, INDIRECT, SPECIAL, 
+#   INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING LOST PROFITS, ARISING OUT OF 
+#   THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION, EVEN IF EVIDENT.IO HAS BEEN HAS BEEN
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# EVIDENT.IO SPECIFICALLY DISCLAIMS ANY WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE. 
+#   THE SOFTWARE AND ACCOMPANYING DOCUMENTATION, IF ANY, PROVIDED HEREUNDER IS PROVIDED "AS IS". 
+#   EVIDENT.IO HAS NO OBLIGATION TO PROVIDE MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS,
+#   OR MODIFICATIONS.
+# 
+#
+# SMTP delivery for the report scripts
+#
+# SmtpPool keeps logged-in SMTP connections open between messages. send() renders a
+# message once and delivers it to every recipient in a single MAIL/RCPT/DATA
+# transaction. send_many() delivers several messages, such as one per team,
+# concurrently over the pool.
+#
+# Usage:
+#
+#   pool = SmtpPool('smtp.gmail.com', 587, user, password)
+#   pool.send(user, ['a@example.com', 'b@example.com'], message)
+#   pool.close()
+#
+# smtp_sink.py is a local SMTP server to deliver to for tests and benchmarks.
+#
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from queue import LifoQueue, Empty
+
+import threading
+import smtplib
+
+
+class SmtpPool():
+
+    def __init__(self, host, port=587, user=None, password=None, starttls=True, size=4, timeout=30):
+        """ Up to `size` reusable, logged-in SMTP connections """
+
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.starttls = starttls
+        self.size = size
+        self.timeout = timeout
+
+        # Most recently used first, so idle connections beyond what's needed age out.
+        self.idle = LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+
+
+    def open(self):
+        """ New connection, after STARTTLS and login when configured """
+
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        server.ehlo()
+        if self.starttls:
+            server.starttls()
+            server.ehlo()
+        if self.user:
+            server.login(self.user, self.password)
+
+        return server
+
+
+    @contextmanager
+    def connection(self):
+        """ Check out a connection, returned to the pool unless it failed """
+
+        with self.slots:
+            try:
+                server = self.idle.get_nowait()
+            except Empty:
+                server = self.open()
+
+            try:
+                yield server
+            except (smtplib.SMTPServerDisconnected, OSError):
+                self.discard(server)
+                raise
+            except smtplib.SMTPException:
+                # The session is still usable after a refused message, unless the server
+                # hung up as well. Either way the refusal is what the caller sees.
+                try:
+                    server.rset()
+                except (smtplib.SMTPException, OSError):
+                    self.discard(server)
+                else:
+                    self.idle.put(server)
+                raise
+            else:
+                self.idle.put(server)
+
+
+    def discard(self, server):
+        """ Close a connection without waiting on a server that may be gone """
+
+        try:
+            server.close()
+        except OSError:
+            pass
+
+
+    def send(self, sender, recipients, message):
+        """ Deliver one message to all recipients, returns the refused recipients """
+
+        # A Message is rendered once here rather than once per recipient.
+        if not isinstance(message, (bytes, str)):
+            message = message.as_bytes()
+
+        # An idle connection may have been dropped by the server, retry once on a new one.
+        for attempt in (1, 2):
+            try:
+                with self.connection() as server:
+                    return server.sendmail(sender, list(recipients), message)
+            except smtplib.SMTPServerDisconnected:
+                if attempt == 2:
+                    raise
+
+
+    def send_many(self, messages):
+        """ Deliver (sender, recipients, message) tuples concurrently, returns their refused recipients in order """
+
+        with ThreadPoolExecutor(max_workers=self.size) as executor:
+            futures = [ executor.submit(self.send, sender, recipients, message) for sender, recipients, message in messages ]
+            return [ future.result() for future in futures ]
+
+
+    def close(self):
+        """ QUIT every idle connection """
+
+        while True:
+            try:
+                server = self.idle.get_nowait()
+            except Empty:
+                return
+            try:
+                server.quit()
+            except (smtplib.SMTPException, OSError):
+                self.discard(server)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, 2014, 2015, 2016, 2017. Evident.io (Evident). All Rights Reserved. 
+# 
+#   Evident.io shall retain all ownership of all right, title and interest in and to 
+#   the Licensed Software, Documentation, Source Code, Object Code, and API's ("Deliverables"), 
+#   including (a) all information and technology capable of general application to Evident.io's
+#   customers; and (b) any works created by Evident.io prior to its commencement of any
+#   Services for Customer.
+# 
+# Upon receipt of all fees, expenses and taxes due in respect of the relevant Services, 
+#   Evident.io grants the Customer a perpetual, royalty-free, non-transferable, license to 
+#   use, copy, configure and translate any Deliverable solely for internal business operations
+#   of the Customer as they relate to the Evident.io platform and products, and always
+#   subject to Evident.io's underlying intellectual property rights.
+# 
+# IN NO EVENT SHALL EVIDENT.IO BE LIABLE TO ANY PARTY FOR DIRECT, INDIRECT, SPECIAL, 
+#   INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING LOST PROFITS, ARISING OUT OF 
+#   THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION, EVEN IF EVIDENT.IO HAS BEEN HAS BEEN
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# EVIDENT.IO SPECIFICALLY DISCLAIMS ANY WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE. 
+#   THE SOFTWARE AND ACCOMPANYING DOCUMENTATION, IF ANY, PROVIDED HEREUNDER IS PROVIDED "AS IS". 
+#   EVIDENT.IO HAS NO OBLIGATION TO PROVIDE MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS,
+#   OR MODIFICATIONS.
+# 
+#
+# Columnar output for the report scripts
+#
+# ParquetWriter writes report rows to a parquet dataset partitioned Hive style by the date
+# of a timestamp column, e.g. esp_audit_log/date=2017-06-01/part-20170601T120000.parquet,
+# which pyarrow, pandas, Spark, Athena and DuckDB all read as one table with a date
+# column. Low-cardinality string columns are dictionary encoded. Rows are buffered per
+# date and written out as a row group every `batch_size` rows, so memory stays bounded
+# however long the window is. Each run adds new part files and never rewrites old ones.
+#
+# Requires pyarrow, `pip install pyarrow`. The other report scripts don't need it.
+#
+# Usage:
+#
+#   types = { 'created_at': 'timestamp', 'successful': 'bool' }
+#   with ParquetWriter('esp_audit_log', head, types, dictionary=['action']) as writer:
+#       writer.writerows(create_report())
+#   print(writer.rows, writer.bytes, writer.files)
+#
+
+from datetime import datetime
+from timestamp_helper import parse_time, parse_times
+
+import os
+
+# Optional, only this module needs it
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+class ParquetWriter():
+
+    def __init__(self, root, fieldnames, types=None, dictionary=(), partition_by='created_at',
+                 part_name=None, batch_size=10000, compression='snappy'):
+        """ Hive partitioned parquet dataset under root, counting what is written
+
+        types maps a field to 'string' (the default), 'bool', 'int', 'float' or 'timestamp'.
+        Timestamps are ISO 8601 strings such as created_at and are stored in UTC. Fields
+        in dictionary are dictionary encoded strings. partition_by is a timestamp field,
+        the date of its value picks the partition of a row.
+        """
+
+        if pyarrow is None:
+            raise Exception('Parquet output requires pyarrow, pip install pyarrow')
+
+        types = types or {}
+        arrow_types = {
+            'string'    : pyarrow.string(),
+            'bool'      : pyarrow.bool_(),
+            'int'       : pyarrow.int64(),
+            'float'     : pyarrow.float64(),
+            'timestamp' : pyarrow.timestamp('ms', tz='UTC')
+        }
+
+        fields = []
+        for name in fieldnames:
+            if name in dictionary:
+                fields.append(pyarrow.field(name, pyarrow.dictionary(pyarrow.int32(), pyarrow.string())))
+            else:
+                fields.append(pyarrow.field(name, arrow_types[types.get(name, 'string')]))
+
+        self.root = root
+        self.fieldnames = list(fieldnames)
+        self.types = types
+        self.schema = pyarrow.schema(fields)
+        self.partition_by = partition_by
+        self.part_name = part_name or 'part-%s.parquet' % (datetime.now().strftime('%Y%m%dT%H%M%S'))
+        self.batch_size = batch_size
+        self.compression = compression
+
+        self.buffers = {}   # date -> {field: [values]}
+        self.writers = {}   # date -> pyarrow.parquet.ParquetWriter
+        self.rows = 0
+        self.closed = False
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+    @property
+    def files(self):
+        """ Part files written, one per date """
+
+        return [ writer.where for writer in self.writers.values() ]
+
+
+    @property
+    def bytes(self):
+        """ Bytes on disk of the part files, complete once closed """
+
+        return sum(os.path.getsize(path) for path in self.files if os.path.exists(path))
+
+
+    def writerow(self, row):
+        """ Buffer one row in its date's partition """
+
+        # 2017-06-01T12:00:00.000Z, the date is the first ten characters. A time with an
+        # offset goes by its UTC date, like the column.
+        value = row.get(self.partition_by) or ''
+        if value.endswith(('Z', 'z')) or len(value) <= 19:
+            date = value[:10] or 'unknown'
+        else:
+            date = parse_time(value).strftime('%Y-%m-%d')
+        buffer = self.buffers.get(date)
+        if buffer is None:
+            buffer = self.buffers[date] = { name: [] for name in self.fieldnames }
+
+        for name in self.fieldnames:
+            buffer[name].append(row.get(name))
+        self.rows += 1
+
+        if len(buffer[self.partition_by]) >= self.batch_size:
+            self.flush(date)
+
+
+    def writerows(self, rows):
+        """ Write rows as the iterable produces them, returns how many """
+
+        count = 0
+        for row in rows:
+            self.writerow(row)
+            count += 1
+
+        return count
+
+
+    def flush(self, date):
+        """ Write a date's buffered rows out as a row group """
+
+        buffer = self.buffers.pop(date, None)
+        if not buffer or not buffer[self.partition_by]:
+            return
+
+        columns = []
+        for field in self.schema:
+            values = buffer[field.name]
+            if pyarrow.types.is_dictionary(field.type) or pyarrow.types.is_string(field.type):
+                # ids and such come back as numbers or strings depending on the endpoint
+                values = pyarrow.array([ v if v is None or isinstance(v, str) else str(v) for v in values ], pyarrow.string())
+                columns.append(values.dictionary_encode() if pyarrow.types.is_dictionary(field.type) else values)
+            elif pyarrow.types.is_timestamp(field.type):
+                # Any fraction or offset parse_time takes, NaT is null
+                columns.append(pyarrow.array(parse_times(values), type=field.type, from_pandas=True))
+            else:
+                columns.append(pyarrow.array(values, field.type))
+        table = pyarrow.Table.from_arrays(columns, schema=self.schema)
+
+        writer = self.writers.get(date)
+        if writer is None:
+            directory = os.path.join(self.root, 'date=%s' % (date))
+            os.makedirs(directory, exist_ok=True)
+            writer = self.writers[date] = pyarrow.parquet.ParquetWriter(os.path.join(directory, self.part_name),
+                                                                         self.schema, compression=self.compression)
+        writer.write_table(table)
+
+
+    def close(self):
+        """ Flush every partition and finish the part files """
+
+        if self.closed:
+            return
+
+        for date in list(self.buffers):
+            self.flush(date)
+        for writer in self.writers.values():
+            writer.close()
+        self.closed = True
+
+
+def write_parquet(root, fieldnames, rows, **options):
+    """ Stream rows to a parquet dataset, returns the closed ParquetWriter with its counts """
+
+    with ParquetWriter(root, fieldnames, **options) as writer:
+        writer.writerows(rows)
+
+    return writer
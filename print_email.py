@@ -10,6 +10,7 @@ import base64
 import cStringIO
 import hmac
 import time
+import os
 
 #=== Description ===
 # Print the list of email addresses of users that the authenticated user has access to.
@@ -34,7 +35,7 @@ secret = <secret key>
 # Process API requests
 def call_api(action, url, data, count = 0):
     # Construct ESP API URL
-    ev_create_url = 'https://api.evident.io%s' % (url)
+    ev_create_url = '%s%s' % (os.environ.get('ESP_API_URL', 'https://api.evident.io'), url)
     
     # Create md5 hash of body
     m = md5.new()
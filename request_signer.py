@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, 2014, 2015, 2016, 2017. Evident.io (Evident). All Rights Reserved. 
+# 
+#   Evident.io shall retain all ownership of all right, title and interest in and to 
+#   the Licensed Software, Documentation, Source Code, Object Code, and API's ("Deliverables"), 
+#   including (a) all information and technology capable of general application to Evident.io's
+#   customers; and (b) any works created by Evident.io prior to its commencement of any
+#   Services for Customer.
+# 
+# Upon receipt of all fees, expenses and taxes due in respect of the relevant Services, 
+#   Evident.io grants the Customer a perpetual, royalty-free, non-transferable, license to 
+#   use, copy, configure and translate any Deliverable solely for internal business operations
+#   of the Customer as they relate to the Evident.io platform and products, and always
+#   subject to Evident.io's underlying intellectual property rights.
+# 
+# IN NO EVENT SHALL EVIDENT.IO BE LIABLE TO ANY PARTY FOR DIRECT, INDIRECT, SPECIAL, 
+#   INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING LOST PROFITS, ARISING OUT OF 
+#   THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION, EVEN IF EVIDENT.IO HAS BEEN HAS BEEN
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# EVIDENT.IO SPECIFICALLY DISCLAIMS ANY WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE. 
+#   THE SOFTWARE AND ACCOMPANYING DOCUMENTATION, IF ANY, PROVIDED HEREUNDER IS PROVIDED "AS IS". 
+#   EVIDENT.IO HAS NO OBLIGATION TO PROVIDE MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS,
+#   OR MODIFICATIONS.
+# 
+# ---
+#
+# APIAuth request signing
+#
+# Signs ESP API requests with HMAC-SHA1 over the canonical string
+# "method,content-type,content-md5,uri,date". Work that doesn't change between requests
+# is done once: the HMAC key schedule, the Content-MD5 of the empty body sent with every
+# GET, and the RFC-1123 Date string, which only changes once a second.
+#
+# signing_benchmark.py compares it with the original per-call implementation.
+#
+
+from wsgiref.handlers import format_date_time
+
+import hashlib
+import hmac
+import base64
+import time
+
+
+class RequestSigner():
+
+    content_type = 'application/vnd.api+json'
+
+    # Content-MD5 of an empty request body
+    empty_md5 = base64.b64encode(hashlib.md5(b'').digest()).decode()
+
+    def __init__(self, pub_key, secret_key):
+        """ Signer for one ESP key pair """
+
+        self.pub_key = pub_key
+
+        # Keyed once, each signature starts from a copy of this state.
+        self.hmac = hmac.new(bytes(secret_key, 'UTF-8'), digestmod=hashlib.sha1)
+
+        # (second, RFC-1123 string) of the last Date header built
+        self.date_cache = (None, None)
+
+
+    def date(self):
+        """ Date header, uses the RFC-1123 spec in the GMT timezone """
+
+        second = int(time.time())
+        cached = self.date_cache
+        if cached[0] != second:
+            cached = (second, format_date_time(second))
+            self.date_cache = cached
+
+        return cached[1]
+
+
+    def content_md5(self, data):
+        """ Base64 MD5 digest of the request body """
+
+        if not data:
+            return self.empty_md5
+
+        return base64.b64encode(hashlib.md5(data.encode('UTF-8')).digest()).decode()
+
+
+    def sign(self, method, uri, data='', dated=None, body=None):
+        """ APIAuth request headers """
+
+        dated = dated or self.date()
+        body = body or self.content_md5(data)
+
+        # Create a canonical string using your HTTP headers containing the HTTP method,
+        # content-type, content-MD5, request URI and the timestamp.
+        canonical = '%s,%s,%s,%s,%s' % (method, self.content_type, body, uri, dated)
+
+        hashed = self.hmac.copy()
+        hashed.update(canonical.encode('UTF-8'))
+        auth = base64.b64encode(hashed.digest()).decode()
+
+        # Add an Authorization header with the ‘APIAuth’, the public key, and the encoded
+        # canonical string.
+        headers = { 'Date'          : dated,
+                    'Content-MD5'   : body,
+                    'Content-Type'  : self.content_type,
+                    'Accept'        : self.content_type,
+                    'Authorization' : 'APIAuth %s:%s' % (self.pub_key, auth) }
+
+        return headers
+
+
+    def sign_batch(self, method, uris, data=''):
+        """ Headers for a list of uris, sharing one Date and body digest """
+
+        dated = self.date()
+        body = self.content_md5(data)
+
+        return [ self.sign(method, uri, data, dated, body) for uri in uris ]
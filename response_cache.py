@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, 2014, 2015, 2016, 2017. Evident.io (Evident). All Rights Reserved. 
+# 
+#   Evident.io shall retain all ownership of all right, title and interest in and to 
+#   the Licensed Software, Documentation, Source Code, Object Code, and API's ("Deliverables"), 
+#   including (a) all information and technology capable of general application to Evident.io's
+#   customers; and (b) any works created by Evident.io prior to its commencement of any
+#   Services for Customer.
+# 
+# Upon receipt of all fees, expenses and taxes due in respect of the relevant Services, 
+#   Evident.io grants the Customer a perpetual, royalty-free, non-transferable, license to 
+#   use, copy, configure and translate any Deliverable solely for internal business operations
+#   of the Customer as they relate to the Evident.io platform and products, and always
+#   subject to Evident.io's underlying intellectual property rights.
+# 
+# IN NO EVENT SHALL EVIDENT.IO BE LIABLE TO ANY PARTY FOR DIRECT, INDIRECT, SPECIAL, 
+#   INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING LOST PROFITS, ARISING OUT OF 
+#   THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION, EVEN IF EVIDENT.IO HAS BEEN HAS BEEN
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# EVIDENT.IO SPECIFICALLY DISCLAIMS ANY WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE. 
+#   THE SOFTWARE AND ACCOMPANYING DOCUMENTATION, IF ANY, PROVIDED HEREUNDER IS PROVIDED "AS IS". 
+#   EVIDENT.IO HAS NO OBLIGATION TO PROVIDE MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS,
+#   OR MODIFICATIONS.
+# 
+# ---
+#
+# API response cache
+#
+# Keeps GET responses in a local SQLite file so repeated runs can skip slow-changing
+# catalogs such as signatures and roles. Each entry is fresh for the TTL of its endpoint.
+# Stale entries that came with an ETag or Last-Modified header are revalidated with a
+# conditional request, so an unchanged catalog costs a 304 and no body. The file is capped
+# at max_bytes of response bodies, dropping the least recently used entries first.
+# Entries are kept per access key and API endpoint, so one file can serve several
+# organizations, or the real API and esp_mock_server.py, without mixing them up.
+#
+# Example:
+#
+#   cache = ResponseCache('esp_api_cache.sqlite', ttls={ '/api/v2/signatures': 86400 })
+#   api = ApiHelper(cache=cache)
+#
+
+from collections import namedtuple
+from urllib.parse import urlsplit
+
+import threading
+import sqlite3
+import time
+import os
+
+# body is the raw response, validators the conditional request headers to send
+CachedResponse = namedtuple('CachedResponse', 'body fresh validators')
+
+
+class ResponseCache():
+
+    def __init__(self, path='esp_api_cache.sqlite', ttls=None, default_ttl=0, max_bytes=64 * 1024 * 1024, namespace=None):
+        """ Open or create the cache file """
+
+        # ttls maps a uri path prefix to seconds, the longest matching prefix wins. With
+        # default_ttl None, responses for any other uri aren't cached at all. namespace
+        # keeps the entries of one organization apart from the others, by default the
+        # ESP_ACCESS_KEY_ID and ESP_API_URL the helpers use.
+        if namespace is None:
+            namespace = '%s@%s' % (os.environ.get('ESP_ACCESS_KEY_ID', ''), os.environ.get('ESP_API_URL', 'https://api.evident.io'))
+        self.namespace = namespace
+        self.ttls = ttls or {}
+        self.default_ttl = default_ttl
+        self.max_bytes = max_bytes
+
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.conn:
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+                                   uri           TEXT PRIMARY KEY,
+                                   body          BLOB,
+                                   etag          TEXT,
+                                   last_modified TEXT,
+                                   stored        REAL,
+                                   accessed      REAL,
+                                   size          INTEGER)""")
+            self.conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+
+
+    def close(self):
+        """ Close the cache file """
+
+        with self.lock:
+            self.conn.close()
+
+
+    def key(self, uri):
+        """ Row key of a uri """
+
+        return self.namespace + ' ' + uri
+
+
+    def ttl(self, uri):
+        """ Seconds a response for this uri stays fresh """
+
+        path = urlsplit(uri).path
+        matches = [ prefix for prefix in self.ttls if path.startswith(prefix) ]
+        if matches:
+            return self.ttls[max(matches, key=len)]
+
+        return self.default_ttl
+
+
+    def lookup(self, uri):
+        """ Cached response for a uri, None if there isn't one """
+
+        if self.ttl(uri) is None:
+            return None
+
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute('SELECT body, etag, last_modified, stored FROM responses WHERE uri = ?', (self.key(uri),)).fetchone()
+            if row is None:
+                return None
+
+            with self.conn:
+                self.conn.execute('UPDATE responses SET accessed = ? WHERE uri = ?', (now, self.key(uri)))
+
+        body, etag, last_modified, stored = row
+
+        validators = {}
+        if etag:
+            validators['If-None-Match'] = etag
+        if last_modified:
+            validators['If-Modified-Since'] = last_modified
+
+        return CachedResponse(body, now - stored < self.ttl(uri), validators)
+
+
+    def store(self, uri, body, headers):
+        """ Save a 200 response """
+
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+
+        # Nothing to gain from a response that is never fresh and can't be revalidated.
+        ttl = self.ttl(uri)
+        if ttl is None or (ttl <= 0 and not etag and not last_modified):
+            return
+
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                              (self.key(uri), body, etag, last_modified, now, now, len(body)))
+            self._evict()
+
+
+    def refresh(self, uri):
+        """ Mark a cached response fresh again after a 304 """
+
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute('UPDATE responses SET stored = ?, accessed = ? WHERE uri = ?', (now, now, self.key(uri)))
+
+
+    def _evict(self):
+        """ Drop least recently used responses until under max_bytes """
+
+        total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        drop = []
+        for uri, size in self.conn.execute('SELECT uri, size FROM responses ORDER BY accessed'):
+            drop.append((uri,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+        self.conn.executemany('DELETE FROM responses WHERE uri = ?', drop)
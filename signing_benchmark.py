@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, 2014, 2015, 2016, 2017. Evident.io (Evident). All Rights Reserved. 
+# 
+#   Evident.io shall retain all ownership of all right, title and interest in and to 
+#   the Licensed Software, Documentation, Source Code, Object Code, and API's ("Deliverables"), 
+#   including (a) all information and technology capable of general application to Evident.io's
+#   customers; and (b) any works created by Evident.io prior to its commencement of any
+#   Services for Customer.
+# 
+# Upon receipt of all fees, expenses and taxes due in respect of the relevant Services, 
+#   Evident.io grants the Customer a perpetual, royalty-free, non-transferable, license to 
+#   use, copy, configure and translate any Deliverable solely for internal business operations
+#   of the Customer as they relate to the Evident.io platform and products, and always
+#   subject to Evident.io's underlying intellectual property rights.
+# 
+# IN NO EVENT SHALL EVIDENT.IO BE LIABLE TO ANY PARTY FOR DIRECT, INDIRECT, SPECIAL, 
+#   INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING LOST PROFITS, ARISING OUT OF 
+#   THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION, EVEN IF EVIDENT.IO HAS BEEN HAS BEEN
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# EVIDENT.IO SPECIFICALLY DISCLAIMS ANY WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE. 
+#   THE SOFTWARE AND ACCOMPANYING DOCUMENTATION, IF ANY, PROVIDED HEREUNDER IS PROVIDED "AS IS". 
+#   EVIDENT.IO HAS NO OBLIGATION TO PROVIDE MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS,
+#   OR MODIFICATIONS.
+# 
+# ---
+#
+# Request signing microbenchmark
+#
+# Signatures per second for the original per-call signing code (as copied into
+# api_helper.py and the standalone scripts) against RequestSigner.
+#
+# Usage: python signing_benchmark.py [number of signatures]
+#
+
+from wsgiref.handlers import format_date_time
+from request_signer import RequestSigner
+from datetime import datetime
+from time import mktime
+
+import hashlib
+import codecs
+import hmac
+import base64
+import time
+import sys
+
+pub_key = 'benchmark-access-key-id'
+secret_key = 'benchmark-secret-access-key-0123456789abcdef'
+
+
+def legacy_headers(method, uri, data):
+    """ Original per-call signing """
+
+    now   = datetime.now()
+    stamp = mktime(now.timetuple())
+    dated = format_date_time(stamp)
+
+    hex  = hashlib.md5(data.encode('UTF-8')).hexdigest()
+    body = codecs.encode(codecs.decode(hex, 'hex'), 'base64').decode().rstrip('\n')
+
+    canonical = '%s,%s,%s,%s,%s' % (method, 'application/vnd.api+json', body, uri, dated)
+
+    secret = bytes(secret_key, 'UTF-8')
+    canonical = bytes(canonical, 'UTF-8')
+
+    hashed = hmac.new(secret, canonical, hashlib.sha1)
+    encoded = base64.b64encode(hashed.digest())
+    auth = str(encoded, 'UTF-8')
+
+    headers = { 'Date'          : '%s' % (dated),
+                'Content-MD5'   : '%s' % (body),
+                'Content-Type'  : 'application/vnd.api+json',
+                'Accept'        : 'application/vnd.api+json',
+                'Authorization' : 'APIAuth %s:%s' % (pub_key, auth) }
+
+    return headers
+
+
+def rate(label, n, fn):
+    """ Time fn() and print signatures per second """
+
+    started = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - started
+    print('%-32s %12.0f signatures/s' % (label, n / elapsed))
+
+    return n / elapsed
+
+
+def main(n):
+    """ Run each variant over the same uris """
+
+    signer = RequestSigner(pub_key, secret_key)
+    uris = [ '/api/v2/reports/%d/alerts?page[number]=1&page[size]=100&filter[status_eq]=fail' % (i) for i in range(n) ]
+    data = '{"data": {"type": "disabled_signatures", "attributes": {"signature_id": 1234}}}'
+
+    # Both produce the same headers for the same Date.
+    legacy = legacy_headers('GET', uris[0], '')
+    if signer.sign('GET', uris[0], '', dated=legacy['Date']) != legacy:
+        print('Error: RequestSigner headers differ from the original implementation.')
+        sys.exit(1)
+
+    print('%d signatures per run\n' % (n))
+    before = rate('GET, original', n, lambda: [ legacy_headers('GET', uri, '') for uri in uris ])
+    after  = rate('GET, RequestSigner.sign', n, lambda: [ signer.sign('GET', uri) for uri in uris ])
+    batch  = rate('GET, RequestSigner.sign_batch', n, lambda: signer.sign_batch('GET', uris))
+    rate('POST, original', n, lambda: [ legacy_headers('POST', uri, data) for uri in uris ])
+    rate('POST, RequestSigner.sign', n, lambda: [ signer.sign('POST', uri, data) for uri in uris ])
+
+    print('\nGET speedup: %.1fx (sign), %.1fx (sign_batch)' % (after / before, batch / before))
+
+
+if __name__ == "__main__":
+
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
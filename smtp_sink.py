@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, 2014, 2015, 2016, 2017. Evident.io (Evident). All Rights Reserved. 
+# 
+#   Evident.io shall retain all ownership of all right, title and interest in and to 
+#   the Licensed Software, Documentation, Source Code, Object Code, and API's ("Deliverables"), 
+#   including (a) all information and technology capable of general application to Evident.io's
+#   customers; and (b) any works created by Evident.io prior to its commencement of any
+#   Services for Customer.
+# 
+# Upon receipt of all fees, expenses and taxes due in respect of the relevant Services, 
+#   Evident.io grants the Customer a perpetual, royalty-free, non-transferable, license to 
+#   use, copy, configure and translate any Deliverable solely for internal business operations
+#   of the Customer as they relate to the Evident.io platform and products, and always
+#   subject to Evident.io's underlying intellectual property rights.
+# 
+# IN NO EVENT SHALL EVIDENT.IO BE LIABLE TO ANY PARTY FOR DIRECT, INDIRECT, SPECIAL, 
+#   INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING LOST PROFITS, ARISING OUT OF 
+#   THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION, EVEN IF EVIDENT.IO HAS BEEN HAS BEEN
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# EVIDENT.IO SPECIFICALLY DISCLAIMS ANY WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE. 
+#   THE SOFTWARE AND ACCOMPANYING DOCUMENTATION, IF ANY, PROVIDED HEREUNDER IS PROVIDED "AS IS". 
+#   EVIDENT.IO HAS NO OBLIGATION TO PROVIDE MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS,
+#   OR MODIFICATIONS.
+# 
+#
+# Local SMTP sink
+#
+# Accepts and counts every message, without delivering anything, so the report scripts'
+# email delivery can be tested and measured offline. Speaks plain SMTP (no STARTTLS, no
+# AUTH): point a script at it with its SMTP host and port, STARTTLS off and no user.
+#
+# --benchmark N sends N messages to a sink in this process, once the way the scripts used
+# to (a new session and one sendmail per recipient) and once through mail_helper.SmtpPool.
+#
+# Usage:
+#
+#   python smtp_sink.py --port 2525 --verbose
+#   python smtp_sink.py --benchmark 200 --recipients 5 --latency 0.01
+#
+
+from socketserver import ThreadingMixIn, TCPServer, StreamRequestHandler
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from mail_helper import SmtpPool
+
+import threading
+import argparse
+import smtplib
+import time
+
+
+class SmtpSink(ThreadingMixIn, TCPServer):
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, keep=False, verbose=False):
+        """ Threaded SMTP server that counts what it receives """
+
+        TCPServer.__init__(self, address, SmtpHandler)
+        self.latency = latency
+        self.keep = keep
+        self.verbose = verbose
+
+        self.lock = threading.Lock()
+        self.sessions = 0
+        self.messages = 0
+        self.recipients = 0
+        self.bytes = 0
+        self.received = [] # (sender, recipients, data) when keep is set
+
+
+    def deliver(self, sender, recipients, data):
+        """ Count a received message """
+
+        with self.lock:
+            self.messages += 1
+            self.recipients += len(recipients)
+            self.bytes += len(data)
+            if self.keep:
+                self.received.append((sender, recipients, data))
+
+        if self.verbose:
+            print('%s -> %s, %d bytes' % (sender, ', '.join(recipients), len(data)))
+
+
+class SmtpHandler(StreamRequestHandler):
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+
+    def handle(self):
+        """ One SMTP session """
+
+        sink = self.server
+        with sink.lock:
+            sink.sessions += 1
+
+        self.reply('220 smtp_sink ready')
+        sender, recipients = None, []
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+
+            # Simulated round-trip time, once per command
+            if sink.latency:
+                time.sleep(sink.latency)
+
+            command, _, argument = line.decode('ascii', 'replace').strip().partition(' ')
+            command = command.upper()
+
+            if command == 'EHLO':
+                self.reply('250-smtp_sink')
+                self.reply('250-8BITMIME')
+                self.reply('250 PIPELINING')
+            elif command == 'HELO':
+                self.reply('250 smtp_sink')
+            elif command == 'MAIL':
+                sender, recipients = argument.partition(':')[2].strip(), []
+                self.reply('250 OK')
+            elif command == 'RCPT':
+                if sender is None:
+                    self.reply('503 MAIL first')
+                else:
+                    recipients.append(argument.partition(':')[2].strip())
+                    self.reply('250 OK')
+            elif command == 'DATA':
+                if not recipients:
+                    self.reply('503 RCPT first')
+                    continue
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                lines = []
+                while True:
+                    line = self.rfile.readline()
+                    if not line or line in (b'.\r\n', b'.\n'):
+                        break
+                    lines.append(line[1:] if line.startswith(b'..') else line)
+                sink.deliver(sender, recipients, b''.join(lines))
+                sender, recipients = None, []
+                self.reply('250 OK')
+            elif command == 'RSET':
+                sender, recipients = None, []
+                self.reply('250 OK')
+            elif command == 'NOOP':
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+def start(host='127.0.0.1', port=0, latency=0.0, keep=False, verbose=False):
+    """ Run a sink in a background thread, returns the sink """
+
+    sink = SmtpSink((host, port), latency=latency, keep=keep, verbose=verbose)
+    thread = threading.Thread(target=sink.serve_forever, daemon=True)
+    thread.start()
+
+    return sink
+
+
+def benchmark(n, recipients, latency, workers):
+    """ Messages per second, one session and sendmail per recipient against SmtpPool """
+
+    sink = start(latency=latency)
+    host, port = sink.server_address[:2]
+    to = [ 'user%d@example.com' % (i) for i in range(recipients) ]
+
+    msg = MIMEMultipart()
+    msg['Subject'] = 'Evident Security Platform: Weekly Risk Summary'
+    msg.attach(MIMEText('x' * 4000))
+
+    start_time = time.time()
+    for i in range(n):
+        server = smtplib.SMTP(host, port)
+        server.ehlo()
+        for email in to:
+            server.sendmail('reports@example.com', email, msg.as_string())
+        server.close()
+    before = n / (time.time() - start_time)
+
+    pool = SmtpPool(host, port, starttls=False, size=workers)
+    start_time = time.time()
+    pool.send_many(('reports@example.com', to, msg) for i in range(n))
+    after = n / (time.time() - start_time)
+    pool.close()
+
+    print('%d messages to %d recipients, %.3fs per command\n' % (n, recipients, latency))
+    print('%-40s %10.1f messages/s' % ('new session, sendmail per recipient', before))
+    print('%-40s %10.1f messages/s' % ('SmtpPool, one transaction, %d workers' % (workers), after))
+    print('\nSpeedup: %.1fx, %d sessions opened in total' % (after / before, sink.sessions))
+    sink.shutdown()
+
+
+def script_args():
+    p = argparse.ArgumentParser(description='Local SMTP sink.')
+    p.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    p.add_argument('--port', type=int, default=2525, help='port to listen on')
+    p.add_argument('--latency', type=float, default=0.0, help='seconds added to every SMTP command')
+    p.add_argument('--verbose', action='store_true', help='log every message')
+    p.add_argument('--benchmark', type=int, metavar='N', help='send N messages to a sink and report throughput, then exit')
+    p.add_argument('--recipients', type=int, default=5, help='recipients per benchmark message')
+    p.add_argument('--workers', type=int, default=4, help='SmtpPool connections in the benchmark')
+    args = p.parse_args()
+
+    return args
+
+
+def main():
+    """ Serve until interrupted """
+
+    args = script_args()
+    if args.benchmark:
+        benchmark(args.benchmark, args.recipients, args.latency, args.workers)
+        return
+
+    sink = start(args.host, args.port, args.latency, verbose=args.verbose)
+    print('SMTP sink at %s:%d' % (args.host, sink.server_address[1]))
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        pass
+
+    print('Received %d messages for %d recipients in %d sessions, %d bytes.' % (sink.messages, sink.recipients, sink.sessions, sink.bytes))
+    sink.shutdown()
+
+
+if __name__ == "__main__":
+
+    main()
@@ -39,137 +39,269 @@
 #   export ESP_ACCESS_KEY_ID=<your_access_key>
 #   export ESP_SECRET_ACCESS_KEY=<your_secret_access_key>
 #
+# Every page of suppressions is listed, `workers` pages at a time.
+#
+workers = 4
+
+# Or sync incrementally: every run writes only the suppressions created, updated or
+# deactivated since the last run to esp_suppressions_changes_YYYYMMDDTHHMMSS.csv, with a
+# Change column. The updated_at and status of every suppression seen are kept in the
+# state file, and only suppressions updated since the newest of those are fetched. The
+# first run lists them all as created. Deleted suppressions aren't reported.
+#
+incremental     = False
+sync_csv_file   = 'esp_suppressions_changes'
+sync_state_file = 'esp_suppressions_state.json'
+
 
-from api_helper import ApiHelper
-from datetime import datetime
+from api_helper import ApiHelper, IncludedIndex
+from csv_helper import write_csv
+from timestamp_helper import parse_time
+from datetime import datetime, timezone
 
+import itertools
 import json
-import csv
 import os
 import re
 
 
-def list_suppressions():
-    """ List of up to 100 suppressions """
+# API time format, always UTC
+time_format = '%Y-%m-%dT%H:%M:%S.000Z'
+
+head = [ 'Suppression Type', 'Status', 'Reason', 'Created On', 'Created By', 'Signature', 'Resource', 'External Accounts', 'Regions' ]
+
+
+def list_suppressions(since=None, workers=workers, created_before=None):
+    """ Every page of suppressions, or of those updated at or after since, in order """
 
-    api = ApiHelper()
+    api = ApiHelper.shared(pool_size=max(10, workers))
 
-    method = 'GET'
-    uri = '/api/v2/suppressions?page[size]=100&include=regions,external_accounts,signatures,created_by'
-    data = ''
+    uri = '/api/v2/suppressions?include=regions,external_accounts,signatures,created_by'
+    if since:
+        uri += '&filter[updated_at_gte]=%s' % (since)
+    if created_before:
+        uri += '&filter[created_at_lte]=%s' % (created_before)
     timeout = (3, 10)
 
-    suppressions = api.api_call(method, uri, data, timeout)
-    
-    return suppressions
+    # The first page's links.last gives the page range, the rest are fetched by a pool
+    # of workers, in no fixed order. Should the set of suppressions change meanwhile,
+    # rows move between pages and may be missed. created_before holds it still: edits
+    # don't change created_at, and anything created later is left out.
+    return api.paginate(uri, page_size=100, timeout=timeout, workers=workers)
 
 
-def element_search(suppressions, element_id):
-    """ Search helper """
+def suppression_documents(pages):
+    """ Suppressions across all pages, with one index of every page's included documents """
 
-    return [ element for element in suppressions['included'] if element['id'] == element_id ]
+    # Relationships are looked up by (type, id) instead of scanning 'included' each time.
+    # Users, signatures, accounts and regions shared by many suppressions are included
+    # on every page that refers to them, the index keeps one copy of each.
+    index = IncludedIndex()
+    seen = set() # should the pages shift, skip the repeats
 
+    for page in pages:
+        if 'errors' in page:
+            raise Exception('%s - %s' % (page['errors'][0]['status'], page['errors'][0]['title']))
 
-def create_suppression_report(suppressions):
-    """ Build a suppressions report """
+        index.add(page.get('included'))
+        for sup in page.get('data') or []:
+            if sup['id'] not in seen:
+                seen.add(sup['id'])
+                yield sup, index
 
-    report = []
-    for i, sup in enumerate(suppressions['data']):
-        #print(i)
 
-        # User email
-        user_id = sup['relationships']['created_by']['data']['id']
-        include = element_search(suppressions, user_id)
-        try:
-            email = include[0]['attributes']['email']
-        except KeyError:
-            email = ''
+def suppression_row(sup, index):
+    """ Report row of a suppression """
 
-        # Signature name
-        try:
-            sig_id = sup['relationships']['signatures']['data'][0]['id']
-        except IndexError:
-            pass
+    # User email
+    user = index.resolve(sup['relationships']['created_by'])
+    try:
+        email = user['attributes']['email']
+    except (KeyError, TypeError):
+        email = ''
+
+    # Signature name
+    sig_name = ''
+    signatures = index.resolve(sup['relationships']['signatures'])
+    if signatures:
+        sig_name = signatures[0]['attributes']['name']
+
+    # External account list
+    ext_accounts = []
+    for acct in index.resolve(sup['relationships']['external_accounts']) or []:
+        ext_accounts.append(acct['attributes']['name'])
+    esp_ext_accounts =  ", ".join( str(e) for e in ext_accounts)
+
+    # Region list
+    regions = []
+    for region in index.resolve(sup['relationships']['regions']) or []:
+        code = region['attributes']['code']
+        regions.append(re.sub('_', '-', code))
+    aws_regions =  ", ".join( str(e) for e in regions)
+
+    # Convert the date
+    creation_date = parse_time(sup['attributes']['created_at'])
+
+    report_info = {
+      'Suppression Type'  : sup['attributes']['suppression_type'],
+      'Status'            : sup['attributes']['status'],
+      'Reason'            : sup['attributes']['reason'],
+      'Created On'        : creation_date.strftime("%B %d, %Y"),
+      'Created By'        : email,
+      'Signature'         : sig_name,
+      'Resource'          : sup['attributes']['resource'],
+      'External Accounts' : esp_ext_accounts,
+      'Regions'           : aws_regions
+    }
+
+    return report_info
+
+
+def create_suppression_report(pages):
+    """ Build a suppressions report, one row at a time """
+
+    for sup, index in suppression_documents(pages):
+        yield suppression_row(sup, index)
+
+
+def load_state(state_file_name):
+    """ Suppressions seen by the last sync, None before the first one """
+
+    if not os.path.exists(state_file_name):
+        return None
+
+    with open(state_file_name) as f:
+        return json.load(f)
+
+
+def save_state(state_file_name, state):
+    """ Replace the state file, never leaving a partial one behind """
+
+    with open(state_file_name + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(state_file_name + '.tmp', state_file_name)
+
+
+def sync_suppressions(state, pages, until):
+    """ Report rows of the suppressions that changed since the last sync up to until, and the new state """
+
+    # state is { 'updated_at': newest updated_at seen, 'suppressions': { id: [updated_at, status] } }.
+    # The server returns suppressions updated at or after the newest one, so the ones
+    # updated in that same second come back again and are skipped here as unchanged.
+    #
+    # A suppression updated while the sync runs could sit on a page already read, so
+    # changes after until, the sync start, are left for the next sync and don't move the
+    # mark. They are dropped here rather than with filter[updated_at_lte]: on the server
+    # they would leave the filtered set, and the rows after them would move up onto
+    # pages already read and be skipped.
+    known = state['suppressions'] if state else {}
+    mark = state['updated_at'] if state else None
+    until = parse_time(until)
+
+    changes = []
+    seen = dict(known)
+    for sup, index in suppression_documents(pages):
+        updated_at = sup['attributes']['updated_at']
+        status = sup['attributes']['status']
+        if parse_time(updated_at) > until:
+            continue
+
+        sup_id = str(sup['id'])
+        previous = known.get(sup_id)
+        if previous == [updated_at, status]:
+            continue
+        if previous is None:
+            change = 'created'
+        elif status == 'inactive' and previous[1] != 'inactive':
+            change = 'deactivated'
         else:
-            include = element_search(suppressions, sig_id)
-
-        sig_name = ''
-        for n in range(2):
-            try:
-                sig_name = include[n]['attributes']['name']
-            except:
-                pass
-
-        # External account list
-        ext_accounts = []
-        for i in sup['relationships']['external_accounts']['data']:
-            include = element_search(suppressions, i['id'])
-            name = include[0]['attributes']['name']
-            ext_accounts.append(name)
-        esp_ext_accounts =  ", ".join( str(e) for e in ext_accounts)
-
-        # Region list
-        regions = []
-        for i in sup['relationships']['regions']['data']:
-            include = element_search(suppressions, i['id'])
-            code = include[0]['attributes']['code']
-            regions.append(re.sub('_', '-', code))
-        aws_regions =  ", ".join( str(e) for e in regions)
-
-        # Convert the date
-        creation_date = datetime.strptime(sup['attributes']['created_at'], '%Y-%m-%dT%H:%M:%S.000Z')
-
-        report_info = {
-          'Suppression Type'  : sup['attributes']['suppression_type'],
-          'Status'            : sup['attributes']['status'],
-          'Reason'            : sup['attributes']['reason'],
-          'Created On'        : creation_date.strftime("%B %d, %Y"),
-          'Created By'        : email,
-          'Signature'         : sig_name,
-          'Resource'          : sup['attributes']['resource'],
-          'External Accounts' : esp_ext_accounts,
-          'Regions'           : aws_regions
-        }
-
-        report.append(report_info)
-
-    return report
+            change = 'updated'
+
+        row = suppression_row(sup, index)
+        row['Change'] = change
+        changes.append(row)
+
+        seen[sup_id] = [updated_at, status]
+        if mark is None or parse_time(updated_at) > parse_time(mark):
+            mark = updated_at
+
+    return changes, { 'updated_at': mark, 'suppressions': seen }
 
 
 def create_csv_file(csv_file_name, report):
-    """ Create csv formatted file """
+    """ Create csv formatted file, streaming the rows in as they are built """
 
+    writer = None
+    error = None
     try:
-        with open(csv_file_name, 'w') as f:
-            head = [ 'Suppression Type', 'Status', 'Reason', 'Created On', 'Created By', 'Signature', 'Resource', 'External Accounts', 'Regions' ]
-            writer = csv.DictWriter(f, fieldnames=head)
-            writer.writeheader()
-            for row in report:
-                writer.writerow(row)
-    except:
-        pass 
-
-    if os.path.exists(csv_file_name) == True and os.stat(csv_file_name).st_size > 0:
-        result = 'Success: Created ESP csv suppressions report, ' + csv_file_name +'.'
+        writer = write_csv(csv_file_name, head, report)
+    except Exception as e:
+        # write_csv has removed the partial file
+        error = e
+
+    if writer and os.path.exists(csv_file_name) == True and os.stat(csv_file_name).st_size > 0:
+        result = 'Success: Created ESP csv suppressions report, %s (%d rows, %d bytes).' % (csv_file_name, writer.rows, writer.bytes)
     else:
         result = 'Error: Failed to create csv file, ' + csv_file_name +'.'
+        if error:
+            result += ' ' + str(error)
 
     return result
 
 
+def create_changes_file(csv_file_name, changes):
+    """ Create csv formatted file of suppression changes, none if nothing changed """
+
+    if not changes:
+        return 'Success: No suppression changes since the last sync.'
+
+    writer = write_csv(csv_file_name, [ 'Change' ] + head, changes)
+
+    return 'Success: Created ESP csv suppression changes, %s (%d changes, %d bytes).' % (csv_file_name, writer.rows, writer.bytes)
+
+
+def sync(state_file_name):
+    """ Write the suppression changes since the last sync, then move the state on """
+
+    state = load_state(state_file_name)
+    start = datetime.now(timezone.utc).strftime(time_format)
+
+    # Pages are read one after another. A suppression updated mid-sync that joins the
+    # filtered set pushes rows down, so a row is read twice rather than skipped.
+    pages = list_suppressions(state['updated_at'] if state else None, workers=1)
+    first = next(pages)
+    if 'errors' in first:
+        print(json.dumps(first, indent = 4))
+        exit(1)
+
+    changes, state = sync_suppressions(state, itertools.chain([first], pages), start)
+    csv_file_name = sync_csv_file + '_' + datetime.now().strftime("%Y%m%dT%H%M%S") + '.csv'
+    result = create_changes_file(csv_file_name, changes)
+
+    # Only save the state once the changes are on disk
+    save_state(state_file_name, state)
+
+    print(result)
+
+
 def main(csv_file_name):
     """ Run checks and do the work """
 
+    if incremental:
+        sync(sync_state_file)
+        return
+
     if os.path.exists(csv_file_name) == True:
         print('Error: The file ' + csv_file_name + ' already exists.')
         exit(1)
 
-    suppressions = list_suppressions()
-    if 'errors' in suppressions:
-        print(json.dumps(suppressions, indent = 4))
+    pages = list_suppressions(created_before=datetime.now(timezone.utc).strftime(time_format))
+    first = next(pages)
+    if 'errors' in first:
+        print(json.dumps(first, indent = 4))
         exit(1)
 
-    report = create_suppression_report(suppressions)
+    report = create_suppression_report(itertools.chain([first], pages))
     result = create_csv_file(csv_file_name, report)
 
     print(result)
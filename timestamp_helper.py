@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2013, 2014, 2015, 2016, 2017. Evident.io (Evident). All Rights Reserved. 
+# 
+#   Evident.io shall retain all ownership of all right, title and interest in and to 
+#   the Licensed Software, Documentation, Source Code, Object Code, and API's ("Deliverables"), 
+#   including (a) all information and technology capable of general application to Evident.io's
+#   customers; and (b) any works created by Evident.io prior to its commencement of any
+#   Services for Customer.
+# 
+# Upon receipt of all fees, expenses and taxes due in respect of the relevant Services, 
+#   Evident.io grants the Customer a perpetual, royalty-free, non-transferable, license to 
+#   use, copy, configure and translate any Deliverable solely for internal business operations
+#   of the Customer as they relate to the Evident.io platform and products, and always
+#   subject to Evident.io's underlying intellectual property rights.
+# 
+# IN NO EVENT SHALL EVIDENT.IO BE LIABLE TO ANY PARTY FOR DIRECT, INDIRECT, SPECIAL, 
+#   INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING LOST PROFITS, ARISING OUT OF 
+#   THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION, EVEN IF EVIDENT.IO HAS BEEN HAS BEEN
+#   ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+# 
+# EVIDENT.IO SPECIFICALLY DISCLAIMS ANY WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+#   THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE. 
+#   THE SOFTWARE AND ACCOMPANYING DOCUMENTATION, IF ANY, PROVIDED HEREUNDER IS PROVIDED "AS IS". 
+#   EVIDENT.IO HAS NO OBLIGATION TO PROVIDE MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS,
+#   OR MODIFICATIONS.
+# 
+#
+# Timestamp parsing for ESP API documents
+#
+# ESP returns times such as created_at as ISO 8601 strings in UTC, 2017-06-01T12:00:00.000Z.
+# datetime.strptime with a '%Y-%m-%dT%H:%M:%S.000Z' format is slow, and fails on any
+# time whose milliseconds aren't .000. parse_time reads the fields by position instead and
+# takes any fraction and a Z or +HH:MM offset. parse_times turns a page of them into one
+# numpy datetime64 array, so a time window check is a single comparison per page.
+#
+# Usage:
+#
+#   created_at = parse_time('2017-06-01T12:00:00.123Z')     # naive datetime in UTC
+#   times = parse_times([ d['attributes']['created_at'] for d in page['data'] ])
+#   in_window = times > to_datetime64(since)
+#
+
+from datetime import datetime, timedelta
+
+# Optional, only the batch functions need it
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def parse_time(value):
+    """ ISO 8601 time string as a naive datetime in UTC, None for None """
+
+    if value is None:
+        return None
+
+    # YYYY-MM-DDTHH:MM:SS.sssZ, what the API sends
+    if len(value) == 24 and value[23] == 'Z':
+        return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                        int(value[11:13]), int(value[14:16]), int(value[17:19]), int(value[20:23]) * 1000)
+
+    # YYYY-MM-DDTHH:MM:SS is fixed width, then an optional fraction and offset
+    time = datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                    int(value[11:13]), int(value[14:16]), int(value[17:19]))
+
+    rest = value[19:]
+    if rest[:1] == '.':
+        digits = 1
+        while digits < len(rest) and rest[digits].isdigit():
+            digits += 1
+        fraction = rest[1:digits]
+        time = time.replace(microsecond=int(fraction[:6].ljust(6, '0')))
+        rest = rest[digits:]
+
+    if rest and rest not in ('Z', 'z'):
+        # +HH:MM, +HHMM or +HH, back to UTC
+        sign = -1 if rest[0] == '-' else 1
+        offset = rest[1:].replace(':', '')
+        time -= sign * timedelta(hours=int(offset[0:2]), minutes=int(offset[2:4] or 0))
+
+    return time
+
+
+def _utc_string(value):
+    """ A time string numpy can read, None for None """
+
+    if value is None or value.endswith(('Z', 'z')) or len(value) <= 19:
+        return value and value.rstrip('Zz')
+
+    # An offset other than Z, normalize through parse_time
+    return parse_time(value).isoformat()
+
+
+def parse_times(values):
+    """ ISO 8601 time strings as a numpy datetime64[ms] array in UTC, NaT for None """
+
+    if np is None:
+        raise Exception('parse_times requires numpy, pip install numpy')
+
+    return np.array([ _utc_string(value) for value in values ], dtype='datetime64[ms]')
+
+
+def to_datetime64(time):
+    """ A naive UTC datetime as numpy datetime64[ms], to compare with parse_times """
+
+    return np.datetime64(time, 'ms')
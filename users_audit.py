@@ -45,8 +45,9 @@
 #   export ESP_SECRET_ACCESS_KEY=<your_secret_access_key>
 #
 
+from csv_helper import write_csv
+
 import esp_sdk
-import csv
 import os
 import json
 import sys
@@ -65,9 +66,8 @@ def script_args():
 
 
 def create_user_report(users):
-    """ Build a user report """
+    """ Build a user report, one row at a time """
 
-    report = []
     for u, user in enumerate(users):
 
         report_info = {
@@ -80,28 +80,27 @@ def create_user_report(users):
           'MFA Enabled'      : user.mfa_enabled
         }
 
-        report.append(report_info)
-
-    return report
+        yield report_info
 
 
 def create_csv_file(csv_file_name, report):
-    """ Create csv formatted file """
+    """ Create csv formatted file, streaming the rows in as they are built """
 
+    writer = None
+    error = None
     try:
-        with open(csv_file_name, 'w') as f:
-            head = [ 'First Name', 'Last Name', 'Email', 'Role', 'Organization', 'Last Updated', 'MFA Enabled' ]
-            writer = csv.DictWriter(f, fieldnames=head)
-            writer.writeheader()
-            for row in report:
-                writer.writerow(row)
-    except:
-        pass 
-
-    if os.path.exists(csv_file_name) == True and os.stat(csv_file_name).st_size > 0:
-        result = 'Success: Created ESP csv user report, ' + csv_file_name +'.'
+        head = [ 'First Name', 'Last Name', 'Email', 'Role', 'Organization', 'Last Updated', 'MFA Enabled' ]
+        writer = write_csv(csv_file_name, head, report)
+    except Exception as e:
+        # write_csv has removed the partial file
+        error = e
+
+    if writer and os.path.exists(csv_file_name) == True and os.stat(csv_file_name).st_size > 0:
+        result = 'Success: Created ESP csv user report, %s (%d rows, %d bytes).' % (csv_file_name, writer.rows, writer.bytes)
     else:
         result = 'Error: Failed to create csv file, ' + csv_file_name +'.'
+        if error:
+            result += ' ' + str(error)
 
     return result
 
@@ -124,7 +123,7 @@ def main(csv_file_name):
         sys.exit(1)
 
     if args.o == 'json':
-        report = create_user_report(users)
+        report = list(create_user_report(users))
         print(json.dumps(report, sort_keys=False, indent=4))
     elif os.path.exists(csv_file_name) == True:
         print('Error: The file ' + csv_file_name + ' already exists.')
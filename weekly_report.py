@@ -1,29 +1,27 @@
-from __future__ import print_function
-from wsgiref.handlers import format_date_time
+from api_helper import ApiHelper, RelationshipResolver
+from mail_helper import SmtpPool
+from response_cache import ResponseCache
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from time import mktime
-from hashlib import sha1
 
-import uuid
-import pycurl
+import numpy as np
+import threading
 import json
-import md5
-import base64
-import cStringIO
-import hmac
-import time
-import smtplib
+import os
 from email.mime.text import MIMEText
-from email.mime.image import MIMEImage
 from email.mime.multipart import MIMEMultipart
 
 #=== Description ===
 # Send an email with weekly stats.  The email includes 3 main sections: 1) total risks across all accounts your
-# user can access, 2) risks by teams, 3) top 5 control checks with most risks
+# user can access, 2) risks by teams, with each team's top control checks, 3) top 5 control checks with most risks
 # Note: risks are failed alerts (does not include warnings)
 #
+# Requirements: Python 3, requests and numpy
+#
 # Instructions:
-# 1. Enter your ESP API Public Key and Secret Key
+# 1. Export your ESP API Public Key and Secret Key
+#    export ESP_ACCESS_KEY_ID=<your_access_key>
+#    export ESP_SECRET_ACCESS_KEY=<your_secret_access_key>
 # 2. Create a Gmail account
 # 3. (Recommended) Enable 2FA and generate an app password
 # 4. Enter your Gmail account and password
@@ -34,82 +32,42 @@ from email.mime.multipart import MIMEMultipart
 
 #=== Configuration ===
 
-# ESP API Access Key Credentials
-public = <public key>
-secret = <secret key>
-
 # Email
 emails = ['admin@somecompany.com']
-gmail_user = <gmail user> # e.g my_account@gmail.com
-gmail_password = <password> # recommend using app password
+gmail_user = '<gmail user>' # e.g my_account@gmail.com
+gmail_password = '<password>' # recommend using app password, None to skip login
+
+# SMTP server. For an offline run against smtp_sink.py: '127.0.0.1', 2525, False and gmail_password = None
+smtp_host = 'smtp.gmail.com'
+smtp_port = 587
+smtp_starttls = True
+
+# Optional per-team summaries, sent concurrently in addition to the summary above
+# e.g. {'Production': ['prod-owners@somecompany.com']}
+team_emails = {}
+
+# Alert counting
+# True:  read each report's failed alerts once and count them by signature and risk level
+# False: count the failed alerts of every signature in every report (one page[size]=1 query per pair)
+single_pass = True
+
+# Number of reports processed concurrently
+workers = 8
+
+# Number of control checks listed in the top risks, for the organization and for each team
+top_risks = 5
+top_team_risks = 3
+
+# Counts of last run, to skip unchanged reports and show the change since then (None to disable)
+snapshot_file = 'weekly_report_snapshot.json'
+
+# Signatures are cached between runs, the catalog rarely changes (None to disable)
+cache_file = 'esp_api_cache.sqlite'
+cache_ttls = {'/api/v2/signatures': 24 * 60 * 60}
 
 #=== End Configuration ===
 
-# Helper method - process API requests
-def call_api(action, ev_create_url, data, count = 0):
-    url = ev_create_url.split('evident.io')[1]
-    
-    # Create md5 hash of body
-    m = md5.new()
-    m.update(data.encode('utf-8'))
-    data_hash = base64.b64encode(m.digest())
-    
-    # Find Time
-    now = datetime.now()
-    stamp = mktime(now.timetuple())
-    
-    # Create Authorization Header
-    canonical = '%s,application/vnd.api+json,%s,%s,%s' % (action, data_hash, url, format_date_time(stamp))
-    
-    hashed = hmac.new(secret, canonical, sha1)
-    auth = hashed.digest().encode("base64").rstrip('\n')
-    
-    # Create Curl request
-    buf = cStringIO.StringIO()
-    c = pycurl.Curl()
-    c.setopt(pycurl.URL, str(ev_create_url))
-    c.setopt(pycurl.HTTPHEADER, [
-        'Date: %s' % format_date_time(stamp),
-        'Content-MD5: %s' % data_hash,
-        'Content-Type: application/vnd.api+json', 
-        'Accept: application/vnd.api+json',
-        'Authorization: APIAuth %s:%s' % (public, auth)])
-    c.setopt(c.WRITEFUNCTION, buf.write)
-    
-    if action == 'POST':
-        c.setopt(pycurl.POST, 1)
-        c.setopt(pycurl.POSTFIELDS, data)
-    elif action == 'PATCH':
-        c.setopt(c.CUSTOMREQUEST, 'PATCH')
-        c.setopt(pycurl.POSTFIELDS, data)
-    elif action == 'DELETE':
-        c.setopt(c.CUSTOMREQUEST, 'DELETE')
-        c.setopt(pycurl.POSTFIELDS, data)
-    c.perform()
-    ev_response = buf.getvalue()
-    buf.close()
-    c.close()
-    ev_response_json = json.loads(ev_response)
-    
-    # Handle rate-limit exceptions
-    if 'errors' in ev_response_json:
-        for error in ev_response_json['errors']:
-            print(error)
-            if int(error['status']) == 429:
-                if count < 5:
-                    # Wait 60 seconds for every retry
-                    time.sleep(60 * (count + 1))
-                    count += 1
-                    print("retry - %s" % count)
-                    return call_api(action, ev_create_url, data, count)
-                else:
-                    # Give-up after 5 retries
-                    return false
-            else:
-                # Throw Exception and end script if any other error occurs
-                raise Exception('%d - %s' % (int(error['status']), error['title']))
-    
-    return ev_response_json
+timeout = (3, 30)
 
 # Helper method - get id from relationship link
 # Example: http://test.host/api/v2/signatures/1003.json
@@ -119,16 +77,170 @@ def get_id(link):
     b = a[len(a) - 1].split(".")
     return int(b[0])
 
-# Helper method - get page number from link
-# Example: https://api.evident.io/api/v2/reports/22952488/alerts?filter%5Bstatus_eq%5D=fail&page%5Bnumber%5D=6&page%5Bsize%5D=20
-# Should return 6
-def get_page_number(link):
-    a = link.split("page%5Bnumber%5D=")
-    b = a[1].split("&")
-    return int(b[0])
+# Helper method - get id of a to-one relationship, from its data or its link
+def related_id(doc, name):
+    relationship = doc['relationships'][name]
+    if relationship.get('data'):
+        return int(relationship['data']['id'])
+    return get_id(relationship['links']['related'])
+
+# Failed alert counts by team and signature
+class RiskMatrix():
+
+    # Layers of the matrix
+    NEW = 0
+    NEW_HIGH = 1
+    TOTAL = 2
+
+    def __init__(self, team_ids, signature_ids):
+        self.team_ids = list(team_ids)
+        self.team_index = {team_id: i for i, team_id in enumerate(self.team_ids)}
+        self.signature_ids = np.array(list(signature_ids), dtype=np.int64)
+        self.signature_index = {int(sig_id): i for i, sig_id in enumerate(self.signature_ids)}
+
+        # layer x team x signature. The last column holds counts that can't be attributed
+        # to a signature, such as new risks from stats or alerts of an unknown signature.
+        self.counts = np.zeros((3, len(self.team_ids), len(self.signature_ids) + 1), dtype=np.int64)
+        self.unattributed = len(self.signature_ids)
+
+    # Column of a signature
+    def column(self, sig_id):
+        return self.signature_index.get(sig_id, self.unattributed)
+
+    # Empty layer x signature counts of one report, to be filled in and added
+    def report_counts(self):
+        return np.zeros((3, self.counts.shape[2]), dtype=np.int64)
+
+    # Add a report's counts to a team
+    def add(self, team_id, counts):
+        if team_id not in self.team_index:
+            self.team_index[team_id] = len(self.team_ids)
+            self.team_ids.append(team_id)
+            self.counts = np.concatenate((self.counts, np.zeros((3, 1, self.counts.shape[2]), dtype=np.int64)), axis=1)
+        self.counts[:, self.team_index[team_id], :] += counts
+
+    # new, new high and total risks of a team
+    def team_totals(self, team_id):
+        return self.counts[:, self.team_index[team_id], :].sum(axis=1)
+
+    # new, new high and total risks of the organization
+    def org_totals(self):
+        return self.counts.sum(axis=(1, 2))
+
+    # Top k signatures by total risks, as (signature_id, count), for a team or the organization
+    def top(self, k, team_id=None):
+        if team_id is None:
+            totals = self.counts[self.TOTAL, :, :self.unattributed].sum(axis=0)
+        else:
+            totals = self.counts[self.TOTAL, self.team_index[team_id], :self.unattributed]
+        k = min(k, np.count_nonzero(totals))
+        if k == 0:
+            return []
+        top = np.argpartition(-totals, k - 1)[:k]
+        top = top[np.argsort(-totals[top], kind='stable')]
+        return [(int(self.signature_ids[i]), int(totals[i])) for i in top]
+
+    # Report counts as {signature_id: [new, new high, total]}, without empty columns
+    def encode(self, counts):
+        encoded = {}
+        for column in np.flatnonzero(counts.any(axis=0)):
+            key = 'unattributed' if column == self.unattributed else str(self.signature_ids[column])
+            encoded[key] = counts[:, column].tolist()
+        return encoded
+
+    # Report counts from encode(), signatures unknown to this matrix are unattributed
+    def decode(self, encoded):
+        counts = self.report_counts()
+        for key, values in encoded.items():
+            column = self.unattributed if key == 'unattributed' else self.column(int(key))
+            counts[:, column] += values
+        return counts
+
+# Load the snapshot of the last run, empty if there is none or it was taken in the other counting mode
+def load_snapshot(path):
+    snapshot = {'date': None, 'single_pass': single_pass, 'reports': {}, 'teams': {}, 'org': None}
+    if path and os.path.exists(path):
+        with open(path) as f:
+            previous = json.load(f)
+        if previous.get('single_pass') == single_pass:
+            snapshot.update(previous)
+    return snapshot
+
+# Save the counts of this run
+def save_snapshot(path, reports, matrix):
+    snapshot = {'date': datetime.today().strftime('%Y-%m-%d'),
+                'single_pass': single_pass,
+                'reports': reports, # report_id - {updated_at, team_id, counts, risk levels}
+                'teams': {str(team_id): matrix.team_totals(team_id).tolist() for team_id in matrix.team_ids},
+                'org': matrix.org_totals().tolist()}
+    with open(path + '.tmp', 'w') as f:
+        json.dump(snapshot, f, separators=(',', ':'))
+    os.replace(path + '.tmp', path)
+
+# Retrieve list of Signatures
+def list_signatures(api):
+    signatures = {} # signature_id - {signature name, identifier}
+    for signatures_json in api.paginate('/api/v2/signatures', page_size=100, timeout=timeout):
+        for signature in signatures_json.get('data', []):
+            new_signature = {'name': signature['attributes']['name'],
+                             'identifier': signature['attributes']['identifier']
+                            }
+            signatures[int(signature['id'])] = new_signature
+    return signatures
+
+# Get stats for latest team
+def latest_for_teams(api):
+    for latest_for_teams_json in api.paginate('/api/v2/stats/latest_for_teams', page_size=100, timeout=timeout):
+        for stat in latest_for_teams_json.get('data', []):
+            yield stat
+
+# Count failed alerts by signature, one count query per signature
+def count_alerts_by_signature(api, report_id, signatures):
+    counts = {}
+    for sig_id in signatures:
+        signature = signatures[sig_id]
+        print("Getting stats for signature %s" % signature['identifier'])
+        alerts_url = '/api/v2/reports/%d/alerts?filter[status_eq]=fail&filter[signature_identifier_cont]=%s' % (report_id, signature['identifier'])
+        counts[sig_id] = api.count(alerts_url, timeout)
+    return counts
+
+# Retrieve failed alerts once and count them by signature and risk level
+def aggregate_alerts(api, report_id, matrix):
+    counts = matrix.report_counts()
+    by_risk_level = {} # risk level - failed alerts
+    alerts_url = '/api/v2/reports/%d/alerts?filter[status_eq]=fail' % report_id
+    for alerts_json in api.paginate(alerts_url, page_size=100, timeout=timeout):
+        for alert in alerts_json.get('data', []):
+            column = matrix.column(related_id(alert, 'signature'))
+            risk_level = alert['attributes'].get('risk_level') or 'Unknown'
+            counts[RiskMatrix.TOTAL, column] += 1
+            by_risk_level[risk_level] = by_risk_level.get(risk_level, 0) + 1
+    return counts, by_risk_level
+
+# Format risk level counts as an extra line, e.g. total risks by risk level - High: 3, Medium: 10, Low: 2
+def format_risk_levels(risk_levels):
+    if not risk_levels:
+        return ''
+    order = ['High', 'Medium', 'Low']
+    levels = sorted(risk_levels, key=lambda level: order.index(level) if level in order else len(order))
+    return '\ntotal risks by risk level - ' + ', '.join('%s: %d' % (level, risk_levels[level]) for level in levels)
+
+# Format the change since the last run, e.g. (+12 since 2017-05-01)
+def format_change(current, previous, date):
+    if previous is None:
+        return ''
+    return ' (%+d since %s)' % (current - previous, date)
+
+# Format top risks under a heading, one line per control check
+def format_top_risks(signatures, top, heading):
+    if not top:
+        return ''
+    return '\n' + heading + ''.join("\n%(signature_name)s - %(total_risks)d " % {'signature_name': signatures[sig_id]['name'], 'total_risks': count} for sig_id, count in top)
 
 # Construct the email body
-def construct_body(teams, signatures, total):
+def construct_body(teams, signatures, matrix, risk_levels, snapshot):
+    new_risks, new_high_risks, total_risks = matrix.org_totals()
+    previous = snapshot['org'] or [None] * 3
     body = """
 Weekly Risk Summary (%(date)s)
 ================================
@@ -136,144 +248,146 @@ Weekly Risk Summary (%(date)s)
 <a href='https://esp.evident.io/reports/alerts/latest?filter%%5Bfirst_seen%%5D=168&filter%%5Bstatus_in%%5D%%5B%%5D=fail'>new risks identified</a>
 %(new_high_risks)d new risks identified
 <a href='https://esp.evident.io/reports/alerts/latest?filter%%5Bfirst_seen%%5D=168&filter%%5Brisk_level_in%%5D=High&filter%%5Bstatus_in%%5D%%5B%%5D=fail'>new high risks identified</a>
-%(total_risks)d total risks identified
-<a href='https://esp.evident.io/reports/alerts/latest?filter%%5Bstatus_in%%5D%%5B%%5D=fail'>total risks identified</a>
-           """ % {'date': datetime.today().strftime('%Y-%m-%d'), 'new_risks': total['new_risks'], 'new_high_risks': total['new_high_risks'], 'total_risks': total['total_risks']}
-    
+%(total_risks)d total risks identified%(total_change)s
+<a href='https://esp.evident.io/reports/alerts/latest?filter%%5Bstatus_in%%5D%%5B%%5D=fail'>total risks identified</a>%(risk_levels)s
+           """ % {'date': datetime.today().strftime('%Y-%m-%d'), 'new_risks': new_risks, 'new_high_risks': new_high_risks, 'total_risks': total_risks, 'risk_levels': format_risk_levels(risk_levels), 'total_change': format_change(total_risks, previous[2], snapshot['date'])}
+
     for team_id in teams:
-        team = teams[team_id]
-        body += """
+        body += construct_team_section(team_id, teams[team_id], signatures, matrix, snapshot)
+
+    body += format_top_risks(signatures, matrix.top(top_risks), 'Top Risks - occurrences') + '\n'
+
+    return body
+
+# Construct the section of a team
+def construct_team_section(team_id, team, signatures, matrix, snapshot):
+    new_risks, new_high_risks, total_risks = matrix.team_totals(team_id)
+    previous = snapshot['teams'].get(str(team_id)) or [None] * 3
+    return """
 %(team_name)s - <a href='https://esp.evident.io/reports/alerts/latest?filter%%5Bexternal_account_team_id_eq%%5D=%(team_id)d&filter%%5Bfirst_seen%%5D=168&filter%%5Bstatus_in%%5D%%5B%%5D=fail'>view latest risks</a>
 new risks identified - %(new_risks)d
 new high risks identified -  %(new_high_risks)d
-total risks identified - %(total_risks)d
-                """ % {'team_name': team['name'], 'team_id': team_id, 'new_risks': team['new_risks'], 'new_high_risks': team['new_high_risks'], 'total_risks': team['total_risks']}
-    
-    top_risks = []
-    # Calculate top 5 risks
-    for sig_id in signatures:
-        signature = signatures[sig_id]
-        position = 0
-        for i in range(6):
-            position = i
-            if i > (len(top_risks) - 1) or signature['total_risks'] > signatures[top_risks[i]]['total_risks']:
-                break
-        
-        top_risks.insert(position, sig_id)
-        
-    body += "\nTop Risks - occurrences\n"
-            
-    for i in range(5):
-        signature = signatures[top_risks[i]]
-        body += "%(signature_name)s - %(total_risks)d \n" % {'signature_name': signature['name'], 'total_risks': signature['total_risks']}
-        
-    return body
-    
-# Send email
-def send_email(subject, body, emails):
-    global gmail_user
-    global gmail_password
-    
+total risks identified - %(total_risks)d%(total_change)s%(risk_levels)s%(top_risks)s
+                """ % {'team_name': team['name'], 'team_id': team_id, 'new_risks': new_risks, 'new_high_risks': new_high_risks, 'total_risks': total_risks, 'risk_levels': format_risk_levels(team['risk_levels']), 'top_risks': format_top_risks(signatures, matrix.top(top_team_risks, team_id), 'top risks - occurrences'), 'total_change': format_change(total_risks, previous[2], snapshot['date'])}
+
+# Construct the email body of a team's summary
+def construct_team_body(team_id, team, signatures, matrix, snapshot):
+    return """
+Weekly Risk Summary for %(team_name)s (%(date)s)
+================================""" % {'team_name': team['name'], 'date': datetime.today().strftime('%Y-%m-%d')} + construct_team_section(team_id, team, signatures, matrix, snapshot)
+
+# Create the email message
+def create_message(subject, body):
     msg = MIMEMultipart()
     msg['Subject'] = subject
 
     text = MIMEText(body)
     msg.attach(text)
+    return msg
 
-    # Send the message via our own SMTP server, but don't include the
-    # envelope header.
-    server = smtplib.SMTP("smtp.gmail.com", 587)
-    server.ehlo()
-    server.starttls()
-    server.login(gmail_user, gmail_password)
-    for email in emails:
-        server.sendmail(gmail_user, email, msg.as_string())
-    server.close()
+# Send email, one message to all recipients in a single SMTP transaction
+def send_email(pool, subject, body, emails):
+    pool.send(gmail_user, emails, create_message(subject, body))
 
+# Send the per-team summaries concurrently
+def send_team_emails(pool, subject, teams, signatures, matrix, snapshot):
+    messages = []
+    for team_id in teams:
+        team = teams[team_id]
+        if team_emails.get(team['name']):
+            body = construct_team_body(team_id, team, signatures, matrix, snapshot)
+            messages.append((gmail_user, team_emails[team['name']], create_message('%s - %s' % (subject, team['name']), body)))
+    pool.send_many(messages)
 
-# === Begin Main Script ===
+# Set a report's new risks from its stats, they can't be attributed to signatures
+def stats_new_risks(counts, stat):
+    counts[RiskMatrix.NEW] = 0
+    counts[RiskMatrix.NEW_HIGH] = 0
+    counts[RiskMatrix.NEW, -1] = stat['attributes']['new_1w_low_fail'] + stat['attributes']['new_1w_medium_fail'] + stat['attributes']['new_1w_high_fail']
+    counts[RiskMatrix.NEW_HIGH, -1] = stat['attributes']['new_1w_high_fail']
 
-teams = {} # team_id - {team name, new risks, new high risks, total risks}
-signatures = {} # signature_id - {signature name, identifier, total risks}
-total = {'new_risks': 0,
-         'new_high_risks': 0,
-         'total_risks': 0} # new risks, new high risks, total risks
- 
-# Retrieve list of Signatures
-signatures_url = 'https://api.evident.io/api/v2/signatures?page[size]=100'
-while signatures_url:
-    data = ''
-    signatures_json = call_api('GET', signatures_url, data)
-    if 'data' in signatures_json:
-        for signature in signatures_json['data']:
-            new_signature = {'name': signature['attributes']['name'],
-                         'identifier': signature['attributes']['identifier'],
-                         'total_risks': 0
-                        }
-            signatures[int(signature['id'])] = new_signature
-        
-        
-    if 'links' in signatures_json and 'next' in signatures_json['links']:
-        signatures_url = signatures_json['links']['next']
+# Count a report's failed alerts, then merge them into the accumulators
+def process_report(api, stat, report, signatures, teams, matrix, risk_levels, snapshot, report_snapshots, lock):
+    report_id = int(report['id'])
+    team_id = related_id(report, 'team')
+    updated_at = report['attributes'].get('updated_at')
+    previous = snapshot['reports'].get(str(report_id))
+
+    if previous and previous['updated_at'] == updated_at:
+        # Unchanged since the last run
+        print("Reusing stats for team %d" % team_id)
+        counts, by_risk_level = matrix.decode(previous['counts']), previous['risk_levels']
+    elif single_pass:
+        print("Getting stats for team %d" % team_id)
+        counts, by_risk_level = aggregate_alerts(api, report_id, matrix)
     else:
-        signatures_url = False
+        print("Getting stats for team %d" % team_id)
+        counts, by_risk_level = matrix.report_counts(), {}
+        for sig_id, count in count_alerts_by_signature(api, report_id, signatures).items():
+            counts[RiskMatrix.TOTAL, matrix.column(sig_id)] += count
 
-# Get stats for latest team
-data = ''
-latest_for_teams_url = 'https://api.evident.io/api/v2/stats/latest_for_teams'
-latest_for_teams_json = call_api('GET', latest_for_teams_url, data)
-
-# Go through each external account and calculate stats
-for stat in latest_for_teams_json['data']:
-    new_risks = stat['attributes']['new_1w_low_fail'] + stat['attributes']['new_1w_medium_fail'] + stat['attributes']['new_1w_high_fail']
-    
-    # Retrieve report
-    report_id = get_id(stat['relationships']['report']['links']['related'])
-    report_url = stat['relationships']['report']['links']['related']
-    report_json = call_api('GET', report_url, data)
-    
-    # Retrieve or create new team object to store risks
-    team_id = get_id(report_json['data']['relationships']['team']['links']['related'])
-    print("Getting stats for team %d" % team_id)
-    if team_id in teams:
+    # New risks always come from this week's stats. Alerts are created when their report
+    # is scanned, so their created_at doesn't tell when a risk was first seen.
+    stats_new_risks(counts, stat)
+
+    with lock:
+        report_snapshots[str(report_id)] = {'updated_at': updated_at, 'team_id': team_id, 'counts': matrix.encode(counts), 'risk_levels': by_risk_level}
+        matrix.add(team_id, counts)
         team = teams[team_id]
-    else:
-        team_url = report_json['data']['relationships']['team']['links']['related']
-        team_json = call_api('GET', team_url, data)
-        team = {'name': team_json['data']['attributes']['name'],
-                'new_risks': new_risks, 
-                'new_high_risks': stat['attributes']['new_1w_high_fail'],
-                'total_risks': 0
-               }
-        teams[team_id] = team
-        total['new_risks'] += new_risks
-        total['new_high_risks'] += stat['attributes']['new_1w_high_fail']
-        
-    # Retrieve failed alerts by signature
-    for sig_id in signatures:
-        signature = signatures[sig_id]
-        print("Getting stats for signature %s" % signature['identifier'])
-        alerts_url = 'https://api.evident.io/api/v2/reports/%d/alerts?page[size]=100&filter[status_eq]=fail&filter[signature_identifier_cont]=%s' % (report_id, signature['identifier'])
-        alerts_json = call_api('GET', alerts_url, data)
-        
-        # Find last page number
-        last_page_num = 1
-        if 'links' in alerts_json and 'last' in alerts_json['links']:
-            alerts_url = alerts_json['links']['last']
-            last_page_num = get_page_num(alerts_url)
-            alerts_json = call_api('GET', alerts_url, data)
-            count = 100 * last_page_num
-        else:
-            count = 0
-            
-        count += len(alerts_json['data'])
-        signature['total_risks'] += count
-        team['total_risks'] += count
-        total['total_risks'] += count
-
-# Send email
-body = construct_body(teams, signatures, total)
-subject = 'Evident Security Platform: Weekly Risk Summary'
-send_email(subject, body, emails)
+        for risk_level, count in by_risk_level.items():
+            team['risk_levels'][risk_level] = team['risk_levels'].get(risk_level, 0) + count
+            risk_levels[risk_level] = risk_levels.get(risk_level, 0) + count
+
+# Calculate risks for every team and signature
+def collect_stats(api, snapshot):
+    risk_levels = {} # risk level - failed alerts, across all teams
+    report_snapshots = {} # report_id - {updated_at, team_id, counts, risk levels}, for the next run
+    lock = threading.Lock() # guards teams, matrix, risk_levels and report_snapshots
+
+    signatures = list_signatures(api)
+    stats = list(latest_for_teams(api))
+
+    # Retrieve the reports and their teams in batches rather than one by one
+    resolver = RelationshipResolver(api, timeout=timeout)
+    resolver.prefetch(stats, 'report')
+    reports = [resolver.resolve(stat['relationships']['report']) for stat in stats]
+    resolver.prefetch(reports, 'team')
+
+    teams = {} # team_id - {team name, risks by risk level}, for teams with a report
+    for report in reports:
+        team = resolver.resolve(report['relationships']['team'])
+        teams[int(team['id'])] = {'name': team['attributes']['name'], 'risk_levels': {}}
+    matrix = RiskMatrix(sorted(teams), signatures)
+
+    # Go through each external account and calculate stats
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(process_report, api, stat, report, signatures, teams, matrix, risk_levels, snapshot, report_snapshots, lock) for stat, report in zip(stats, reports)]
+        for future in futures:
+            future.result()
+
+    return teams, signatures, matrix, risk_levels, report_snapshots
+
+
+# === Begin Main Script ===
+
+if __name__ == "__main__":
+
+    cache = ResponseCache(cache_file, ttls=cache_ttls, default_ttl=None) if cache_file else None
+    api = ApiHelper.shared(pool_size=max(10, workers), cache=cache)
+    snapshot = load_snapshot(snapshot_file)
+    teams, signatures, matrix, risk_levels, report_snapshots = collect_stats(api, snapshot)
+
+    # Send email
+    pool = SmtpPool(smtp_host, smtp_port, gmail_user if gmail_password else None, gmail_password, starttls=smtp_starttls)
+    body = construct_body(teams, signatures, matrix, risk_levels, snapshot)
+    subject = 'Evident Security Platform: Weekly Risk Summary'
+    send_email(pool, subject, body, emails)
+    send_team_emails(pool, subject, teams, signatures, matrix, snapshot)
+    pool.close()
+
+    if snapshot_file:
+        save_snapshot(snapshot_file, report_snapshots, matrix)
+    if cache:
+        cache.close()
 
 # === End Main Script ===